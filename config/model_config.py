@@ -4,15 +4,45 @@ from dotenv import load_dotenv
 # 让 Python 读取根目录的 .env
 load_dotenv()
 
-def get_model_config():
-    target = os.getenv("MODEL_TARGET", "local").upper()
+def _read_concurrency(target, default=4):
+    """解析 {TARGET}_MAX_CONCURRENCY；为空或非法时退回默认值，不影响其他读取配置的脚本"""
+    raw = os.getenv(f"{target}_MAX_CONCURRENCY", "").strip()
+    if not raw:
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        print(f"警告：{target}_MAX_CONCURRENCY={raw!r} 不是整数，使用默认值 {default}")
+        return default
+    return value if value > 0 else default
+
+
+def get_model_config(target=None):
+    """
+    读取一个模型目标的配置；target 为空时使用 .env 中的 MODEL_TARGET。
+    {TARGET}_MAX_CONCURRENCY 为该目标的并发上限（多模型评测时使用）。
+    """
+    target = (target or os.getenv("MODEL_TARGET", "local")).upper()
 
     model_name = os.getenv(f"{target}_MODEL_NAME")
     api_base = os.getenv(f"{target}_API_BASE")
     api_key = os.getenv(f"{target}_API_KEY")
 
     return {
+        "target": target,
         "name": model_name,
         "base_url": api_base,
         "api_key": api_key,
+        "max_concurrency": _read_concurrency(target),
     }
+
+
+def list_model_targets():
+    """列出 .env 中配置了 _MODEL_NAME 与 _API_BASE 的全部目标"""
+    targets = []
+    for key, value in os.environ.items():
+        if key.endswith("_MODEL_NAME") and value:
+            target = key[: -len("_MODEL_NAME")]
+            if os.getenv(f"{target}_API_BASE"):
+                targets.append(target)
+    return sorted(targets)
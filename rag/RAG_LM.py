@@ -11,7 +11,13 @@ from pathlib import Path
 import chromadb
 from sentence_transformers import SentenceTransformer
 from config.model_config import get_model_config
-from scripts.openai_client import call_chat_completion
+from scripts.openai_client import call_chat_completion, stream_chat_completion
+from scripts.card_store import iter_cards_from
+from scripts.card_archive import iter_archived
+from scripts import tracing
+from rag.context_builder import pack_context
+from rag.semantic_cache import SemanticCache
+from rag.landscape import PATTERNS, EmotionLandscape, format_extremes
 
 
 class EmotionRAG:
@@ -23,6 +29,11 @@ class EmotionRAG:
         embedding_model: str = "moka-ai/m3e-base",
         chunk_size: int = 800,
         chunk_overlap: int = 200,
+        context_budget: int = 1500,
+        answer_cache: SemanticCache | None = None,
+        collection_name: str = "emotion_data",
+        embedder: SentenceTransformer | None = None,
+        chroma_client=None,
     ):
         """
         初始化RAG系统
@@ -34,16 +45,36 @@ class EmotionRAG:
             embedding_model: 中文向量化模型
         chunk_size: 文本分块大小
         chunk_overlap: 块间重叠字符数
+            context_budget: 拼接进 prompt 的检索上下文 token 上限
+            answer_cache: 语义回答缓存，None 表示不缓存
+            collection_name: 向量集合名称（多用户时每个用户一个集合）
+            embedder: 共享的向量模型实例，提供时不再重复加载
+            chroma_client: 共享的 Chroma 客户端
         """
         self.model_cfg = get_model_config()
-
-        print("加载向量模型...")
-        self.embedder = SentenceTransformer(embedding_model)
-
-        print("初始化向量数据库...")
-        self.chroma_client = chromadb.Client()
-        self.collection = self.chroma_client.create_collection(
-            name="emotion_data", metadata={"hnsw:space": "cosine"}
+        self.chunk_overlap = chunk_overlap
+        self.context_budget = context_budget
+        self.answer_cache = answer_cache
+        # 新卡片入库后的回调（关键词索引等），参数为本批卡片列表
+        self.ingest_listeners = []
+        # 情绪地形聚合随卡片入库增量更新
+        self.landscape = EmotionLandscape()
+        self.ingest_listeners.append(self.landscape.add)
+        self.jsonl_path = None
+        self.jsonl_offset = 0
+
+        if embedder is None:
+            print("加载向量模型...")
+            embedder = SentenceTransformer(embedding_model)
+        self.embedder = embedder
+
+        if chroma_client is None:
+            print("初始化向量数据库...")
+            chroma_client = chromadb.Client()
+        self.chroma_client = chroma_client
+        self.collection_name = collection_name
+        self.collection = self.chroma_client.get_or_create_collection(
+            name=collection_name, metadata={"hnsw:space": "cosine"}
         )
 
         if jsonl_path:
@@ -54,48 +85,51 @@ class EmotionRAG:
             self.load_project_files(project_paths, chunk_size, chunk_overlap)
         print(f"✅系统初始化完成！共加载 {self.collection.count()} 条数据")
 
-    def load_data(self, jsonl_path: str):
-        """加载JSONL数据并建立索引"""
-        with open(jsonl_path, "r", encoding="utf-8") as f:
-            for line_num, line in enumerate(f, 1):
-                line = line.strip()
-                if not line:
-                    continue
-
-                last_brace = line.rfind("}")
-                json_str = line[: last_brace + 1] if last_brace != -1 else line
+    def load_data(self, jsonl_path: str, batch_size: int = 64):
+        """
+        加载JSONL数据并建立索引，返回读到的字节偏移，供增量追读使用
 
-                try:
-                    item = json.loads(json_str)
-                except json.JSONDecodeError as e:
-                    print(f"警告：跳过第{line_num}行，JSON解析失败: {e}")
-                    continue
+        先读已移入按月分片的往月卡片（见 scripts.card_archive），再读 cards.jsonl 本身。
+        """
+        for items in iter_archived(jsonl_path, batch_size=batch_size):
+            self.upsert_cards(items)
+        offset = 0
+        for items, offset in iter_cards_from(jsonl_path, batch_size=batch_size):
+            self.upsert_cards(items)
+        self.jsonl_path = jsonl_path
+        self.jsonl_offset = offset
+        return offset
+
+    def upsert_cards(self, items: list[dict]):
+        """批量向量化卡片并写入（或覆盖）集合，随后通知已注册的索引；跳过标记为重复的卡片"""
+        items = [item for item in items if item.get("id") and not item.get("duplicate_of")]
+        if not items:
+            return 0
+        search_texts = [self._build_search_text(item) for item in items]
+        embeddings = self.embed(search_texts)
+        with tracing.span("chroma.upsert"):
+            self.collection.upsert(
+                embeddings=embeddings,
+                documents=search_texts,
+                metadatas=[self._card_metadata(item) for item in items],
+                ids=[item["id"] for item in items],
+            )
+        for listener in self.ingest_listeners:
+            listener(items)
+        return len(items)
 
-                search_text = self._build_search_text(item)
-                embedding = self.embedder.encode(search_text).tolist()
-
-                spectrum = item.get("spectrum", {})
-                self.collection.add(
-                    embeddings=[embedding],
-                    documents=[search_text],
-                    metadatas=[
-                        {
-                            "source": "jsonl",
-                            "raw_text": item.get("raw_text", ""),
-                            "summary": item.get("summary", ""),
-                            "keywords": json.dumps(
-                                item.get("keywords", []), ensure_ascii=False
-                            ),
-                            "valence": spectrum.get("valence", 0.0),
-                            "arousal": spectrum.get("arousal", 0.0),
-                            "tones": json.dumps(
-                                spectrum.get("tones", []), ensure_ascii=False
-                            ),
-                            "metaphor_domain": item.get("metaphor_domain", ""),
-                        }
-                    ],
-                    ids=[item["id"]],
-                )
+    def _card_metadata(self, item):
+        spectrum = item.get("spectrum", {})
+        return {
+            "source": "jsonl",
+            "raw_text": item.get("raw_text", ""),
+            "summary": item.get("summary", ""),
+            "keywords": json.dumps(item.get("keywords", []), ensure_ascii=False),
+            "valence": spectrum.get("valence", 0.0),
+            "arousal": spectrum.get("arousal", 0.0),
+            "tones": json.dumps(spectrum.get("tones", []), ensure_ascii=False),
+            "metaphor_domain": item.get("metaphor_domain", ""),
+        }
 
     def load_project_files(
         self,
@@ -118,7 +152,7 @@ class EmotionRAG:
                 for i, chunk in enumerate(
                     self._split_text(text, chunk_size, chunk_overlap)
                 ):
-                    embedding = self.embedder.encode(chunk).tolist()
+                    embedding = self.embed(chunk)
                     self.collection.add(
                         embeddings=[embedding],
                         documents=[chunk],
@@ -154,6 +188,16 @@ class EmotionRAG:
             f"隐喻域：{item.get('metaphor_domain', '')}"
         )
 
+    def embed(self, texts):
+        """向量化单条文本或文本列表，返回 list（可直接传给 Chroma）"""
+        with tracing.span("embed"):
+            return self.embedder.encode(texts).tolist()
+
+    def drop(self):
+        """删除本实例的向量集合，释放内存"""
+        self.chroma_client.delete_collection(self.collection_name)
+        self.collection = None
+
     def chat_completion(self, messages, temperature=0.7, max_tokens=None):
         """调用 .env 中配置的 OpenAI-Compatible API 获取回复"""
         cfg = self.model_cfg
@@ -167,7 +211,19 @@ class EmotionRAG:
         )
         return resp["choices"][0]["message"]["content"]
 
-    def search(self, query, top_k=3, valence_filter=None):
+    def chat_completion_stream(self, messages, temperature=0.7, max_tokens=None):
+        """流式调用，逐段产出回复文本"""
+        cfg = self.model_cfg
+        yield from stream_chat_completion(
+            cfg["base_url"],
+            cfg["api_key"],
+            cfg["name"],
+            messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+
+    def search(self, query, top_k=3, valence_filter=None, query_embedding=None):
         """
         语义检索
 
@@ -175,8 +231,10 @@ class EmotionRAG:
             query: 查询文本
             top_k: 返回结果数量
             valence_filter: 情感效价过滤 (min, max)
+            query_embedding: 已计算好的查询向量，提供时不再重复编码
         """
-        query_embedding = self.embedder.encode(query).tolist()
+        if query_embedding is None:
+            query_embedding = self.embed(query)
 
         where_filter = None
         if valence_filter:
@@ -187,32 +245,36 @@ class EmotionRAG:
                 ]
             }
 
-        results = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=top_k,
-            where=where_filter,
-        )
+        with tracing.span("chroma.query"):
+            results = self.collection.query(
+                query_embeddings=[query_embedding],
+                n_results=top_k,
+                where=where_filter,
+            )
 
         return results
 
-    def query(self, question, top_k=3, temperature=0.7):
+    def build_context(self, results, token_budget=None):
         """
-        RAG问答
+        将检索结果打包为预算内的上下文条目，合并同一文件的重叠分块
 
-        Args:
-            question: 用户问题
-            top_k: 检索文档数量
-            temperature: LLM生成温度
+        Returns:
+            (entries, stats)，见 rag.context_builder.pack_context
         """
-        print("\n🔍 检索相关数据...")
-        results = self.search(question, top_k=top_k)
+        with tracing.span("context.build"):
+            return pack_context(
+                results["documents"][0],
+                results["metadatas"][0],
+                token_budget=token_budget or self.context_budget,
+                chunk_overlap=self.chunk_overlap,
+            )
 
+    def build_messages(self, question, entries):
+        """把打包好的上下文条目与问题拼成对话消息"""
         context_parts = []
-        for i, (doc, metadata) in enumerate(
-            zip(results["documents"][0], results["metadatas"][0]), 1
-        ):
+        for i, entry in enumerate(entries, 1):
             context_parts.append(
-                f"\n【数据{i}】\n来源: {metadata.get('source', 'unknown')} {metadata.get('path', '')}\n{doc}\n"
+                f"\n【数据{i}】\n来源: {entry['source']} {entry['path']}\n{entry['text']}\n"
             )
 
         context = "\n".join(context_parts)
@@ -224,38 +286,128 @@ class EmotionRAG:
             "请结合数据中的原文、情感维度（效价/唤醒度）、关键词、情感色调和隐喻域进行深入分析，"
             "用简洁要点回答。"
         )
+        return [
+            {
+                "role": "system",
+                "content": "你是一个专业的情感分析助手，擅长理解和分析人类情感表达，回答要简洁。",
+            },
+            {"role": "user", "content": prompt},
+        ]
+
+    def query(self, question, top_k=3, temperature=0.7):
+        """
+        RAG问答
+
+        Args:
+            question: 用户问题
+            top_k: 检索文档数量
+            temperature: LLM生成温度
+        """
+        with tracing.span("rag.query"):
+            return self._query(question, top_k, temperature)
+
+    def _query(self, question, top_k, temperature):
+        print("\n🔍 检索相关数据...")
+        query_embedding = self.embed(question)
+        results = self.search(question, top_k=top_k, query_embedding=query_embedding)
+
+        cache_params = {"mode": "query", "top_k": top_k, "temperature": temperature}
+        if self.answer_cache is not None:
+            cached = self.answer_cache.lookup(
+                query_embedding, results["ids"][0], cache_params
+            )
+            if cached is not None:
+                print("\n💬 回复（语义缓存）：")
+                print(cached)
+                print("\n")
+                return cached
+
+        entries, _ = self.build_context(results)
 
         print("🤖 生成回复...")
         content = self.chat_completion(
-            messages=[
-                {
-                    "role": "system",
-                    "content": "你是一个专业的情感分析助手，擅长理解和分析人类情感表达，回答要简洁。",
-                },
-                {"role": "user", "content": prompt},
-            ],
+            messages=self.build_messages(question, entries),
             temperature=temperature,
         )
 
+        if self.answer_cache is not None:
+            self.answer_cache.store(
+                query_embedding, results["ids"][0], content, cache_params
+            )
+
         print("\n💬 回复：")
         print(content)
         print("\n")
         return content
 
-    def analyze_emotion_pattern(self, emotion_type):
-        """分析特定情感模式"""
-        query_map = {
-            "消极": "找出最消极悲伤的情感表达",
-            "积极": "找出最积极快乐的情感表达",
-            "激烈": "找出情绪最强烈激动的表达",
-            "平静": "找出情绪最平静淡定的表达",
-        }
+    def query_stream(self, question, top_k=3, temperature=0.7, max_tokens=None):
+        """
+        流式 RAG 问答：检索与上下文打包完成后逐段产出回复
 
-        if emotion_type in query_map:
-            return self.query(query_map[emotion_type], top_k=5)
-        else:
+        命中语义缓存时一次性产出缓存的回复；完整回复在流结束后写入缓存。
+        """
+        query_embedding = self.embed(question)
+        results = self.search(question, top_k=top_k, query_embedding=query_embedding)
+
+        cache_params = {"mode": "query", "top_k": top_k, "temperature": temperature}
+        if max_tokens is not None:
+            cache_params["max_tokens"] = max_tokens
+        if self.answer_cache is not None:
+            cached = self.answer_cache.lookup(
+                query_embedding, results["ids"][0], cache_params
+            )
+            if cached is not None:
+                yield cached
+                return
+
+        entries, _ = self.build_context(results)
+        parts = []
+        for text in self.chat_completion_stream(
+            self.build_messages(question, entries),
+            temperature=temperature,
+            max_tokens=max_tokens,
+        ):
+            parts.append(text)
+            yield text
+
+        if self.answer_cache is not None:
+            self.answer_cache.store(
+                query_embedding, results["ids"][0], "".join(parts), cache_params
+            )
+
+    def analyze_emotion_pattern(self, emotion_type, k=5, narrate=False, temperature=0.7):
+        """
+        分析特定情感模式：直接从情绪地形聚合中取效价 / 唤醒度最极端的卡片
+
+        Args:
+            emotion_type: 消极、积极、激烈、平静
+            k: 返回的卡片数
+            narrate: 是否再请 LLM 基于这些卡片与整体分布写一段简短分析
+        """
+        if emotion_type not in PATTERNS:
             return "不支持的情感类型，请选择：消极、积极、激烈、平静"
 
+        with tracing.span("landscape.pattern"):
+            report = format_extremes(emotion_type, self.landscape.extremes(emotion_type, k))
+        if not narrate:
+            return report
+
+        prompt = (
+            f"以下是情感数据库的整体分布与其中最{emotion_type}的卡片。\n\n"
+            f"整体分布：\n{self.landscape.describe()}\n\n{report}\n\n"
+            "请概括这些表达的共同特征（意象、色调、隐喻域），用简洁要点回答。"
+        )
+        return self.chat_completion(
+            messages=[
+                {
+                    "role": "system",
+                    "content": "你是一个专业的情感分析助手，擅长理解和分析人类情感表达，回答要简洁。",
+                },
+                {"role": "user", "content": prompt},
+            ],
+            temperature=temperature,
+        )
+
 
 def main():
     """使用示例"""
@@ -288,14 +440,19 @@ def main():
 
     # 交互模式
     print("\n" + "=" * 60)
-    print("进入交互模式（输入'quit'退出）")
+    print("进入交互模式（输入'quit'退出；输入 消极 / 积极 / 激烈 / 平静 或 外观 查看情绪地形）")
     print("=" * 60)
 
     while True:
         question = input("\n请输入问题：").strip()
         if question.lower() in ["quit", "exit", "退出"]:
             break
-        if question:
+        if question in PATTERNS:
+            # 消极 / 积极 / 激烈 / 平静：直接查情绪地形，不走检索
+            print(rag.analyze_emotion_pattern(question))
+        elif question in ("外观", "地形"):
+            print(rag.landscape.describe())
+        elif question:
             rag.query(question)
 
 
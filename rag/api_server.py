@@ -0,0 +1,287 @@
+"""
+无界面的 HTTP API：长驻进程内共享一个向量模型与各用户的索引，供应用后端调用。
+
+依赖：pip install fastapi uvicorn
+用法示例：
+python rag/api_server.py --port 8000 --llm-concurrency 8
+
+接口：
+- POST /cards    单条 {"text": ...} 或批量 {"items": [{"text": ...}, ...]}；
+                 条目自带 "draft" 时直接入库，否则按 mode（full / reply / local）生成
+- GET  /search   ?q=...&user=...&top_k=3&valence_min=&valence_max=
+- POST /query    {"question": ...}，以 text/plain 流式返回回答
+- GET  /landscape ?user=...&pattern=消极&k=5，情绪地形聚合
+- GET  /stats、/metrics
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Literal, Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from starlette.background import BackgroundTask
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from scripts import tracing  # noqa: E402
+
+
+class CardItem(BaseModel):
+    text: str
+    draft: Optional[dict] = None
+
+
+class CardsRequest(BaseModel):
+    user: Optional[str] = None
+    mode: Literal["full", "reply", "local"] = "full"
+    text: Optional[str] = None
+    draft: Optional[dict] = None
+    items: Optional[list[CardItem]] = None
+
+
+class QueryRequest(BaseModel):
+    question: str
+    user: Optional[str] = None
+    top_k: int = 3
+    temperature: float = 0.7
+    max_tokens: Optional[int] = None
+
+
+def create_app(registry, llm_concurrency: int = 8) -> FastAPI:
+    """
+    Args:
+        registry: TenantRegistry，所有请求共享其向量模型、常驻索引与各用户的预分类器
+        llm_concurrency: 生成卡片时同时进行的 LLM 调用上限
+    """
+    from scripts.input import generate_draft
+
+    app = FastAPI(title="Amnesia API")
+    # 名额由 call_chat_completion 在线程内取得，等待时间计入 llm_queue_seconds；
+    # 生成任务放在独立线程池里排队，不占用其他接口共用的线程池
+    llm_slots = threading.Semaphore(llm_concurrency)
+    llm_pool = ThreadPoolExecutor(max_workers=llm_concurrency * 4, thread_name_prefix="llm")
+
+    async def generate_one(text, mode, classifier):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            llm_pool, lambda: generate_draft(text, mode, classifier, limiter=llm_slots)
+        )
+
+    @app.post("/cards")
+    async def create_cards(req: CardsRequest):
+        if req.items is not None:
+            items = req.items
+        elif req.text is not None:
+            items = [CardItem(text=req.text, draft=req.draft)]
+        else:
+            raise HTTPException(400, "需要 text 或 items")
+        items = [CardItem(text=item.text.strip(), draft=item.draft) for item in items]
+        if not items or any(not item.text for item in items):
+            raise HTTPException(400, "text 不能为空")
+
+        with tracing.span("api.cards", mode=req.mode):
+            pending = [i for i, item in enumerate(items) if item.draft is None]
+            drafts = {i: (item.draft, "") for i, item in enumerate(items) if item.draft is not None}
+            errors = {}
+            classifier = None
+            if pending and req.mode != "full":
+                # reply / local 模式用该用户自己的卡片训练的预分类器，首次使用时训练
+                try:
+                    classifier = await run_in_threadpool(registry.classifier, req.user)
+                except ValueError as e:
+                    raise HTTPException(400, str(e))
+
+            if pending and req.mode == "local":
+                # 不调用 LLM，整批一次向量化
+                batch = await run_in_threadpool(
+                    classifier.classify_batch, [items[i].text for i in pending]
+                )
+                drafts.update((i, (draft, "")) for i, draft in zip(pending, batch))
+            elif pending:
+                outcomes = await asyncio.gather(
+                    *(generate_one(items[i].text, req.mode, classifier) for i in pending),
+                    return_exceptions=True,
+                )
+                for i, outcome in zip(pending, outcomes):
+                    if isinstance(outcome, Exception):
+                        errors[i] = str(outcome)
+                    else:
+                        drafts[i] = outcome
+
+            order = sorted(drafts)
+            try:
+                cards, kept = await run_in_threadpool(
+                    registry.save_cards, req.user, [(items[i].text, drafts[i][0]) for i in order]
+                )
+            except ValueError as e:
+                raise HTTPException(400, str(e))
+
+        written = {card["id"] for card in kept}
+        results = [None] * len(items)
+        for i, card in zip(order, cards):
+            # 与已有记忆重复时带上 duplicate_of；skip 策略下该卡片未写入，标记 skipped
+            results[i] = {
+                "card": card,
+                "reply": drafts[i][1],
+                "duplicate_of": card.get("duplicate_of"),
+                "skipped": card["id"] not in written,
+            }
+        for i, message in errors.items():
+            results[i] = {"error": message}
+        return {
+            "saved": len(kept),
+            "skipped": len(cards) - len(kept),
+            "failed": len(errors),
+            "results": results,
+        }
+
+    @app.get("/search")
+    async def search(
+        q: str,
+        user: Optional[str] = None,
+        top_k: int = 3,
+        valence_min: Optional[float] = None,
+        valence_max: Optional[float] = None,
+    ):
+        valence_filter = None
+        if valence_min is not None or valence_max is not None:
+            valence_filter = (
+                valence_min if valence_min is not None else -1.0,
+                valence_max if valence_max is not None else 1.0,
+            )
+        try:
+            with tracing.span("api.search"):
+                results = await run_in_threadpool(
+                    registry.search, user, q, top_k=top_k, valence_filter=valence_filter
+                )
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+        hits = []
+        for doc_id, doc, meta, dist in zip(
+            results["ids"][0],
+            results["documents"][0],
+            results["metadatas"][0],
+            results["distances"][0],
+        ):
+            hits.append({"id": doc_id, "document": doc, "metadata": meta, "distance": dist})
+        return {"results": hits}
+
+    @app.post("/query")
+    async def query(req: QueryRequest):
+        if not req.question.strip():
+            raise HTTPException(400, "question 不能为空")
+        try:
+            # 先在这里取得（必要时加载）用户索引的租约，非法 id 能以 400 返回而不是中断流；
+            # 租约在回答流结束时归还
+            stream = await run_in_threadpool(
+                registry.query_stream,
+                req.user,
+                req.question,
+                top_k=req.top_k,
+                temperature=req.temperature,
+                max_tokens=req.max_tokens,
+            )
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+        # 同步迭代器由 Starlette 放到线程池中逐段迭代；响应结束后关闭回答流以归还租约
+        # （客户端提前断开时由回答流被回收时归还）
+        return StreamingResponse(
+            stream, media_type="text/plain; charset=utf-8", background=BackgroundTask(stream.close)
+        )
+
+    @app.get("/landscape")
+    async def landscape(user: Optional[str] = None, pattern: Optional[str] = None, k: int = 5):
+        """情绪地形快照；给出 pattern（消极 / 积极 / 激烈 / 平静）时附带最极端的 k 张卡片"""
+
+        def build():
+            with registry.lease(user) as rag:
+                body = rag.landscape.snapshot()
+                if pattern:
+                    body["extremes"] = rag.landscape.extremes(pattern, k)
+                return body
+
+        try:
+            body = await run_in_threadpool(build)
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+        return body
+
+    @app.get("/stats")
+    async def stats():
+        return await run_in_threadpool(registry.stats)
+
+    @app.get("/metrics")
+    async def metrics():
+        return PlainTextResponse(
+            tracing.render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8"
+        )
+
+    return app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Amnesia headless HTTP API")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="监听地址")
+    parser.add_argument("--port", type=int, default=8000, help="端口")
+    parser.add_argument(
+        "--embedding-model",
+        type=str,
+        default="moka-ai/m3e-base",
+        help="SentenceTransformer 模型名称",
+    )
+    parser.add_argument("--max-resident", type=int, default=32, help="常驻内存的用户索引数上限")
+    parser.add_argument("--max-memory-mb", type=float, default=512, help="常驻索引的内存预算（MB）")
+    parser.add_argument(
+        "--context-budget", type=int, default=1500, help="拼接进 prompt 的检索上下文 token 上限"
+    )
+    parser.add_argument("--llm-concurrency", type=int, default=8, help="生成卡片的 LLM 并发上限")
+    parser.add_argument(
+        "--dedup-embed-threshold",
+        type=float,
+        default=None,
+        help="写入去重时额外做向量相似度检查的阈值（如 0.95），默认只做哈希与 MinHash",
+    )
+    parser.add_argument(
+        "--preload", action="append", default=[], help="启动时预先加载的用户 id，可重复"
+    )
+    return parser.parse_args()
+
+
+def main():
+    import uvicorn
+
+    from rag.tenants import TenantRegistry
+
+    args = parse_args()
+    # 提示词、emotion_schema 与 data/ 均按项目根目录的相对路径读取
+    os.chdir(ROOT)
+    registry = TenantRegistry(
+        max_resident=args.max_resident,
+        max_memory_mb=args.max_memory_mb,
+        embedding_model=args.embedding_model,
+        context_budget=args.context_budget,
+        dedup_embedding_threshold=args.dedup_embed_threshold,
+    )
+    # 默认图书馆总是预热，避免第一个请求承担建索引的耗时
+    registry.get(None)
+    for user_id in args.preload:
+        registry.get(user_id)
+
+    app = create_app(registry, llm_concurrency=args.llm_concurrency)
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
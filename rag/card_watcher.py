@@ -0,0 +1,140 @@
+"""
+cards.jsonl 实时追读：chat_to_card / input 新写入的卡片无需重启即可被检索。
+
+按字节偏移追读新增的完整行，小批量向量化后 upsert 进运行中的集合。
+文件被 card_dedup compact 替换或被截断时，按新文件重新对齐集合与情绪地形。
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+
+from rag.RAG_LM import EmotionRAG
+from scripts.card_archive import iter_archived
+from scripts.card_store import file_identity, iter_cards_from
+
+
+class CardTailer:
+    def __init__(
+        self,
+        rag: EmotionRAG,
+        jsonl_path: str | None = None,
+        poll_interval: float = 1.0,
+        batch_size: int = 32,
+    ):
+        """
+        Args:
+            rag: 运行中的 EmotionRAG 实例
+            jsonl_path: 追读的文件，默认沿用 rag.load_data 加载过的文件
+            poll_interval: 轮询间隔（秒），决定索引延迟的上限
+            batch_size: 每次向量化的卡片数
+        """
+        self.rag = rag
+        self.jsonl_path = jsonl_path or rag.jsonl_path
+        if not self.jsonl_path:
+            raise ValueError("未指定要追读的 cards.jsonl")
+        # 与 rag 加载的是同一文件时，从已读到的位置继续，避免全量重建
+        self.offset = rag.jsonl_offset if self.jsonl_path == rag.jsonl_path else 0
+        self.identity = file_identity(self.jsonl_path)
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.indexed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._created_at = time.time()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll_once(self) -> int:
+        """读取并索引一次新增内容，返回本次入库的卡片数"""
+        try:
+            identity = file_identity(self.jsonl_path)
+            size = os.path.getsize(self.jsonl_path)
+        except OSError:
+            return 0
+        count = 0
+        if identity != self.identity or size < self.offset:
+            count = self._resync()
+            self.identity = identity
+        if size == self.offset:
+            self.indexed += count
+            return count
+
+        newest = None
+        for items, self.offset in iter_cards_from(self.jsonl_path, self.offset, self.batch_size):
+            count += self.rag.upsert_cards(items)
+            if items:
+                newest = max(newest or 0, max(item.get("created_at", 0) for item in items))
+        if newest is not None:
+            # 索引延迟：从最新卡片写入（created_at）到可检索为止；
+            # 追读开始前就已存在的卡片按开始时间计
+            now = time.time()
+            written_at = max(newest / 1000, self._created_at)
+            self.last_lag = max(0.0, now - written_at)
+            self.max_lag = max(self.max_lag, self.last_lag)
+        self.rag.jsonl_offset = self.offset
+        self.indexed += count
+        return count
+
+    def _resync(self) -> int:
+        """
+        文件被替换（compact、按月归档）或截断：连同已归档的分片从头读一遍，删掉集合里已不存在的卡片，
+        重建情绪地形；已在集合中的卡片不再重新向量化。返回新入库的卡片数
+        """
+        collection = self.rag.collection
+        indexed = set(collection.get(where={"source": "jsonl"}, include=[])["ids"])
+        self.rag.landscape.reset()
+        keep = set()
+        count = 0
+
+        def realign(items):
+            items = [item for item in items if item.get("id") and not item.get("duplicate_of")]
+            keep.update(item["id"] for item in items)
+            # 新卡片由 upsert_cards 通知情绪地形，这里只补回已在集合中的
+            self.rag.landscape.add([item for item in items if item["id"] in indexed])
+            return self.rag.upsert_cards([item for item in items if item["id"] not in indexed])
+
+        for items in iter_archived(self.jsonl_path, self.batch_size):
+            count += realign(items)
+        self.offset = 0
+        for items, self.offset in iter_cards_from(self.jsonl_path, 0, self.batch_size):
+            count += realign(items)
+        stale = list(indexed - keep)
+        if stale:
+            collection.delete(ids=stale)
+        self.rag.jsonl_offset = self.offset
+        print(f"🔄 {self.jsonl_path} 已被替换或截断，移除 {len(stale)} 张已删除的卡片")
+        return count
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                count = self.poll_once()
+                if count:
+                    print(f"📥 新增 {count} 张卡片已入库（延迟 {self.last_lag:.2f}s）")
+            except Exception as e:
+                print(f"警告：追读 {self.jsonl_path} 失败: {e}")
+            self._stop.wait(self.poll_interval)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="card-tailer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float | None = None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            "offset": self.offset,
+            "indexed": self.indexed,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
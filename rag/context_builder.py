@@ -0,0 +1,192 @@
+"""
+RAG 上下文打包：在 token 预算内拼接检索结果。
+
+- 同一文件中相邻的项目分块会按重叠部分拼接成一段，避免重复内容多次进入 prompt
+- 超出预算时，卡片优先退化为精简字段（摘要 / 关键词 / 情感光谱），其次截断、丢弃排名靠后的片段
+- 预算是硬上限：只剩一条时也会把它截到预算以内
+"""
+
+from __future__ import annotations
+
+import json
+import re
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约 1 字 1 token，其余约 4 字符 1 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def _load_list(value):
+    if isinstance(value, list):
+        return value
+    if not value:
+        return []
+    try:
+        data = json.loads(value)
+    except (TypeError, json.JSONDecodeError):
+        return []
+    return data if isinstance(data, list) else []
+
+
+def compact_card_text(metadata: dict, raw_limit: int = 60) -> str:
+    """只保留卡片的精简字段；摘要为空时用截断后的原文代替"""
+    summary = metadata.get("summary", "")
+    keywords = _load_list(metadata.get("keywords"))
+    tones = _load_list(metadata.get("tones"))
+    lines = []
+    if summary:
+        lines.append(f"摘要：{summary}")
+    else:
+        raw = metadata.get("raw_text", "")
+        if len(raw) > raw_limit:
+            raw = raw[:raw_limit] + "…"
+        lines.append(f"原文：{raw}")
+    if keywords:
+        lines.append(f"关键词：{', '.join(keywords)}")
+    lines.append(
+        f"情感维度：效价{metadata.get('valence', 0.0)}, 唤醒度{metadata.get('arousal', 0.0)}"
+    )
+    if tones:
+        lines.append(f"情感色调：{', '.join(tones)}")
+    return "\n".join(lines)
+
+
+def _merge_overlap(left: str, right: str, max_overlap: int) -> str:
+    """拼接相邻分块，去掉 right 开头与 left 结尾重复的部分"""
+    limit = min(max_overlap, len(left), len(right))
+    for k in range(limit, 0, -1):
+        if left.endswith(right[:k]):
+            return left + right[k:]
+    return left + right
+
+
+def _collapse_project_chunks(entries: list[dict], chunk_overlap: int) -> list[dict]:
+    """同一文件中连续编号的分块合并为一条，保留首个分块的排名位置"""
+    by_path: dict[str, list[dict]] = {}
+    for entry in entries:
+        if entry["source"] == "project" and entry["path"]:
+            by_path.setdefault(entry["path"], []).append(entry)
+
+    merged_into: dict[int, dict] = {}
+    for group in by_path.values():
+        if len(group) < 2:
+            continue
+        group.sort(key=lambda e: e["chunk"])
+        head = group[0]
+        for entry in group[1:]:
+            if entry["chunk"] == head["last_chunk"] + 1:
+                head["text"] = _merge_overlap(head["text"], entry["text"], chunk_overlap)
+                head["last_chunk"] = entry["chunk"]
+                head["rank"] = min(head["rank"], entry["rank"])
+                merged_into[id(entry)] = head
+            elif entry["chunk"] <= head["last_chunk"]:
+                # 重复命中同一分块
+                merged_into[id(entry)] = head
+            else:
+                head = entry
+
+    out = [e for e in entries if id(e) not in merged_into]
+    out.sort(key=lambda e: e["rank"])
+    return out
+
+
+def pack_context(
+    documents: list[str],
+    metadatas: list[dict],
+    token_budget: int = 1500,
+    chunk_overlap: int = 200,
+    verbose: bool = True,
+):
+    """
+    将检索结果打包为预算内的上下文条目
+
+    Args:
+        documents: 检索返回的文档（按相关度排序）
+        metadatas: 对应的元数据
+        token_budget: 上下文 token 上限（硬上限，final_tokens 不会超过它）
+        chunk_overlap: 项目分块的重叠字符数，用于拼接相邻分块
+
+    Returns:
+        (entries, stats)：entries 中每项包含 source / path / text / tokens；
+        stats 记录原始与最终 token 数
+    """
+    entries = []
+    seen_docs = set()
+    for rank, (doc, meta) in enumerate(zip(documents, metadatas)):
+        meta = meta or {}
+        if doc in seen_docs:
+            continue
+        seen_docs.add(doc)
+        chunk = meta.get("chunk", 0)
+        entries.append(
+            {
+                "rank": rank,
+                "source": meta.get("source", "unknown"),
+                "path": meta.get("path", ""),
+                "chunk": chunk,
+                "last_chunk": chunk,
+                "meta": meta,
+                "text": doc,
+            }
+        )
+
+    original_tokens = sum(estimate_tokens(doc) for doc in documents)
+    entries = _collapse_project_chunks(entries, chunk_overlap)
+    for entry in entries:
+        entry["tokens"] = estimate_tokens(entry["text"])
+
+    def total():
+        return sum(e["tokens"] for e in entries)
+
+    # 1) 从排名最低的卡片开始替换为精简字段
+    for entry in reversed(entries):
+        if total() <= token_budget:
+            break
+        if entry["source"] == "jsonl":
+            entry["text"] = compact_card_text(entry["meta"])
+            entry["tokens"] = estimate_tokens(entry["text"])
+
+    # 2) 仍超预算：截断或丢弃排名靠后的条目；只剩第一条时截到预算以内，
+    #    连省略号都放不下时才丢弃
+    while entries and total() > token_budget:
+        last = entries[-1]
+        target = last["tokens"] - (total() - token_budget)
+        if target >= 50 or (len(entries) == 1 and target >= 2):
+            # 预留省略号的 1 个 token，且每轮至少去掉一个字符，保证收敛
+            base = last["text"].rstrip("…")
+            keep = min(len(base) - 1, max(1, int(len(base) * (target - 1) / last["tokens"])))
+            last["text"] = base[:keep] + "…"
+            last["tokens"] = estimate_tokens(last["text"])
+        else:
+            entries.pop()
+
+    final_tokens = total()
+    stats = {
+        "original_tokens": original_tokens,
+        "final_tokens": final_tokens,
+        "saved_tokens": max(0, original_tokens - final_tokens),
+        "entries": len(entries),
+    }
+    if verbose and stats["saved_tokens"]:
+        print(
+            f"📦 上下文打包：{original_tokens} → {final_tokens} tokens，"
+            f"节省 {stats['saved_tokens']}"
+        )
+
+    packed = [
+        {
+            "source": e["source"],
+            "path": e["path"],
+            "text": e["text"],
+            "tokens": e["tokens"],
+        }
+        for e in entries
+    ]
+    return packed, stats
@@ -0,0 +1,236 @@
+"""
+情绪地形：随卡片入库增量维护的聚合统计，回答“最消极 / 最积极 / 最激烈 / 最平静”与图书馆外观。
+
+- 效价 / 唤醒度直方图及二维分布、均值与标准差
+- 各色调（tones）、隐喻域（metaphor_domain）、效价唤醒象限的计数
+- 按本地日期分桶的滚动时间窗统计（最近 7 天、30 天……）
+- 四个大小为 k 的堆，分别保存效价最低 / 最高、唤醒度最高 / 最低的卡片
+
+注册为 EmotionRAG.ingest_listeners 的回调，每张卡片只做 O(log k) 的更新，查询不碰向量库和 LLM。
+"""
+
+from __future__ import annotations
+
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import Counter
+from datetime import date
+
+# 模式名 -> (维度, 方向)；方向为 1 取最大，-1 取最小
+PATTERNS = {
+    "消极": ("valence", -1),
+    "积极": ("valence", 1),
+    "激烈": ("arousal", 1),
+    "平静": ("arousal", -1),
+}
+
+def _to_float(value, default=None):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return default
+    return value if math.isfinite(value) else default
+
+
+def _bin(value, low, high, bins):
+    idx = int((value - low) / (high - low) * bins)
+    return min(max(idx, 0), bins - 1)
+
+
+class EmotionLandscape:
+    def __init__(self, bins: int = 10, top_k: int = 10):
+        """
+        Args:
+            bins: 效价 / 唤醒度直方图的分箱数
+            top_k: 每个极值堆保留的卡片数，也是 extremes 能返回的上限
+        """
+        self.bins = bins
+        self.top_k = top_k
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        bins = self.bins
+        self._seq = itertools.count()
+        self._seen: set[str] = set()
+
+        self.count = 0
+        self.sums = {"valence": 0.0, "arousal": 0.0}
+        self.sumsq = {"valence": 0.0, "arousal": 0.0}
+        self.valence_hist = [0] * bins
+        self.arousal_hist = [0] * bins
+        self.grid = [[0] * bins for _ in range(bins)]
+        self.tones: Counter = Counter()
+        self.domains: Counter = Counter()
+        self.quadrants: Counter = Counter()
+        # 本地日期的序号（date.toordinal）-> [数量, 效价和, 唤醒度和]
+        self.days: dict[int, list] = {}
+        # (维度, 方向) -> 小顶堆 [(方向 × 取值, 序号, 卡片摘要)]
+        self.heaps: dict[tuple[str, int], list] = {key: [] for key in PATTERNS.values()}
+
+    def reset(self):
+        """清空全部聚合（卡片文件被 compact 替换后，由追读方重新登记）"""
+        with self._lock:
+            self._clear()
+
+    def add(self, cards):
+        """登记一批卡片（同一 id 只计一次），可直接作为 ingest_listeners 回调"""
+        with self._lock:
+            for card in cards:
+                self._add_one(card)
+
+    def _add_one(self, card):
+        cid = card.get("id")
+        if not cid or cid in self._seen:
+            return
+        spectrum = card.get("spectrum") or {}
+        valence = _to_float(spectrum.get("valence"))
+        arousal = _to_float(spectrum.get("arousal"))
+        if valence is None or arousal is None:
+            return
+        self._seen.add(cid)
+        valence = min(max(valence, -1.0), 1.0)
+        arousal = min(max(arousal, 0.0), 1.0)
+
+        self.count += 1
+        for name, value in (("valence", valence), ("arousal", arousal)):
+            self.sums[name] += value
+            self.sumsq[name] += value * value
+        v_bin = _bin(valence, -1.0, 1.0, self.bins)
+        a_bin = _bin(arousal, 0.0, 1.0, self.bins)
+        self.valence_hist[v_bin] += 1
+        self.arousal_hist[a_bin] += 1
+        self.grid[a_bin][v_bin] += 1
+
+        tones = spectrum.get("tones") or []
+        if isinstance(tones, str):
+            tones = [tones]
+        self.tones.update(t for t in tones if isinstance(t, str) and t)
+        domain = card.get("metaphor_domain")
+        if domain:
+            self.domains[domain] += 1
+        quadrant = ("pos" if valence >= 0 else "neg") + ("_high" if arousal >= 0.5 else "_low")
+        self.quadrants[quadrant] += 1
+
+        created_at = card.get("created_at")
+        if isinstance(created_at, (int, float)):
+            # 按本机时区的日期分桶，“今天”与用户的日历一致（而不是 UTC 零点切换）
+            day = date.fromtimestamp(created_at / 1000).toordinal()
+            bucket = self.days.setdefault(day, [0, 0.0, 0.0])
+            bucket[0] += 1
+            bucket[1] += valence
+            bucket[2] += arousal
+
+        entry = {
+            "id": cid,
+            "raw_text": card.get("raw_text", ""),
+            "summary": card.get("summary", ""),
+            "valence": valence,
+            "arousal": arousal,
+            "tones": list(tones),
+            "metaphor_domain": domain or "",
+            "created_at": created_at,
+        }
+        values = {"valence": valence, "arousal": arousal}
+        seq = next(self._seq)
+        for (dim, direction), heap in self.heaps.items():
+            item = (direction * values[dim], seq, entry)
+            if len(heap) < self.top_k:
+                heapq.heappush(heap, item)
+            elif item[0] > heap[0][0]:
+                heapq.heapreplace(heap, item)
+
+    # ---------- 查询 ----------
+
+    def extremes(self, emotion_type: str, k: int | None = None) -> list[dict]:
+        """某一模式下最极端的 k 张卡片，按极端程度排序；k 不能超过构造时的 top_k"""
+        if emotion_type not in PATTERNS:
+            raise ValueError(f"不支持的情感类型 {emotion_type!r}，请选择：{'、'.join(PATTERNS)}")
+        if k is not None and k > self.top_k:
+            raise ValueError(f"k={k} 超过了极值堆保留的 {self.top_k} 张，请用更大的 top_k 构造 EmotionLandscape")
+        with self._lock:
+            heap = list(self.heaps[PATTERNS[emotion_type]])
+        ranked = sorted(heap, key=lambda item: (-item[0], item[1]))
+        return [entry for _, _, entry in ranked[: k or self.top_k]]
+
+    def window(self, days: int, now: float | None = None) -> dict:
+        """最近 days 天（含今天，按本地日期）的卡片数与平均效价 / 唤醒度"""
+        today = date.fromtimestamp(now if now is not None else time.time()).toordinal()
+        count, v_sum, a_sum = 0, 0.0, 0.0
+        with self._lock:
+            for day in range(today - days + 1, today + 1):
+                bucket = self.days.get(day)
+                if bucket:
+                    count += bucket[0]
+                    v_sum += bucket[1]
+                    a_sum += bucket[2]
+        return {
+            "days": days,
+            "count": count,
+            "valence_mean": v_sum / count if count else None,
+            "arousal_mean": a_sum / count if count else None,
+        }
+
+    def _moments(self, name):
+        if not self.count:
+            return None, None
+        mean = self.sums[name] / self.count
+        var = max(self.sumsq[name] / self.count - mean * mean, 0.0)
+        return mean, math.sqrt(var)
+
+    def snapshot(self, top_n: int = 8, windows=(7, 30)) -> dict:
+        """图书馆外观：全部聚合的 JSON 快照"""
+        with self._lock:
+            v_mean, v_std = self._moments("valence")
+            a_mean, a_std = self._moments("arousal")
+            snap = {
+                "count": self.count,
+                "valence": {"mean": v_mean, "std": v_std, "hist": list(self.valence_hist)},
+                "arousal": {"mean": a_mean, "std": a_std, "hist": list(self.arousal_hist)},
+                "grid": [list(row) for row in self.grid],
+                "tones": self.tones.most_common(top_n),
+                "domains": self.domains.most_common(),
+                "quadrants": dict(self.quadrants),
+            }
+        snap["windows"] = [self.window(days) for days in windows]
+        return snap
+
+    def describe(self, top_n: int = 8) -> str:
+        """把快照整理成 Markdown，供界面或 LLM 叙述使用"""
+        snap = self.snapshot(top_n=top_n)
+        if not snap["count"]:
+            return "_图书馆还是空的_"
+        v, a = snap["valence"], snap["arousal"]
+        lines = [
+            f"共 {snap['count']} 张卡片；平均效价 {v['mean']:+.2f}（±{v['std']:.2f}），"
+            f"平均唤醒度 {a['mean']:.2f}（±{a['std']:.2f}）",
+            "",
+            "- 象限：" + "，".join(f"{k} {n}" for k, n in sorted(snap["quadrants"].items())),
+            "- 隐喻域：" + "，".join(f"{k} {n}" for k, n in snap["domains"]),
+            "- 常见色调：" + "，".join(f"{k} {n}" for k, n in snap["tones"]),
+        ]
+        for w in snap["windows"]:
+            if w["count"]:
+                lines.append(
+                    f"- 最近 {w['days']} 天：{w['count']} 张，平均效价 {w['valence_mean']:+.2f}，"
+                    f"平均唤醒度 {w['arousal_mean']:.2f}"
+                )
+            else:
+                lines.append(f"- 最近 {w['days']} 天：没有新卡片")
+        return "\n".join(lines)
+
+
+def format_extremes(emotion_type: str, entries: list[dict]) -> str:
+    """极值卡片的文字列表"""
+    dim = "效价" if PATTERNS[emotion_type][0] == "valence" else "唤醒度"
+    lines = [f"最{emotion_type}的 {len(entries)} 张卡片（按{dim}排序）："]
+    for i, e in enumerate(entries, 1):
+        tones = "、".join(e["tones"])
+        lines.append(
+            f"{i}. [效价 {e['valence']:+.2f} / 唤醒度 {e['arousal']:.2f}] {e['raw_text']}"
+            + (f"（{tones}；{e['metaphor_domain']}）" if tones or e["metaphor_domain"] else "")
+        )
+    return "\n".join(lines)
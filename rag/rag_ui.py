@@ -9,6 +9,7 @@ python scripts/rag_ui.py --jsonl data/cards.jsonl --project readme.md --project
 from __future__ import annotations
 
 import argparse
+import atexit
 from pathlib import Path
 from typing import List, Optional
 
@@ -23,6 +24,10 @@ if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
 
 from rag.RAG_LM import EmotionRAG  # noqa: E402
+from rag.semantic_cache import SemanticCache  # noqa: E402
+from rag.card_watcher import CardTailer  # noqa: E402
+from scripts.card_store import user_cards_path  # noqa: E402
+from scripts import tracing  # noqa: E402
 
 
 def discover_md_log_files(root: Path) -> List[str]:
@@ -38,7 +43,7 @@ def discover_md_log_files(root: Path) -> List[str]:
 def build_rag(args) -> EmotionRAG:
     jsonl_path = args.jsonl
     if not jsonl_path:
-        default_jsonl = ROOT / "data" / "cards.jsonl"
+        default_jsonl = ROOT / user_cards_path(args.user)
         if default_jsonl.exists():
             jsonl_path = str(default_jsonl)
             print(f"ℹ️ 未提供 --jsonl，默认使用 {jsonl_path}")
@@ -56,6 +61,14 @@ def build_rag(args) -> EmotionRAG:
             uniq_projects.append(p)
             seen.add(p)
 
+    answer_cache = None
+    if args.cache_threshold > 0:
+        answer_cache = SemanticCache(
+            threshold=args.cache_threshold,
+            max_entries=args.cache_size,
+            watch_path=jsonl_path,
+        )
+
     return EmotionRAG(
         jsonl_path=jsonl_path,
         project_paths=uniq_projects if uniq_projects else None,
@@ -63,18 +76,20 @@ def build_rag(args) -> EmotionRAG:
         embedding_model=args.embedding_model,
         chunk_size=args.chunk_size,
         chunk_overlap=args.chunk_overlap,
+        context_budget=args.context_budget,
+        answer_cache=answer_cache,
     )
 
 
-def format_context(documents, metadatas) -> str:
+def format_context(entries) -> str:
     parts = []
-    for i, (doc, meta) in enumerate(zip(documents, metadatas), 1):
-        source = meta.get("source", "unknown")
-        path = meta.get("path", "")
+    for i, entry in enumerate(entries, 1):
+        source = entry.get("source", "unknown")
+        path = entry.get("path", "")
         title = f"数据 {i}（{source}）"
         if path:
             title += f" - {path}"
-        parts.append(f"### {title}\n\n```\n{doc}\n```")
+        parts.append(f"### {title}\n\n```\n{entry['text']}\n```")
     return "\n\n".join(parts) if parts else "_未检索到内容_"
 
 
@@ -86,11 +101,27 @@ def make_answer_fn(rag: EmotionRAG, args):
     def answer(question: str, top_k: int, temperature: float, max_tokens: int):
         if not question.strip():
             return "请输入问题。", "_无上下文_"
+        with tracing.span("ui.answer"):
+            return _answer(question, top_k, temperature, max_tokens)
 
-        results = rag.search(question, top_k=top_k)
-        context_md = format_context(
-            results["documents"][0], results["metadatas"][0]
-        )
+    def _answer(question: str, top_k: int, temperature: float, max_tokens: int):
+        query_embedding = rag.embed(question)
+        results = rag.search(question, top_k=top_k, query_embedding=query_embedding)
+        cache = rag.answer_cache
+        cache_params = {
+            "mode": "ui",
+            "top_k": top_k,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+        if cache is not None:
+            cached = cache.lookup(query_embedding, results["ids"][0], cache_params)
+            if cached is not None:
+                print(f"⚡ 命中语义缓存，命中率 {cache.stats()['hit_rate']:.1%}")
+                return cached
+
+        entries, _ = rag.build_context(results)
+        context_md = format_context(entries)
 
         prompt = (
             "你是一个情感分析专家。基于以下项目资料（代码仓库中的 README/日志/文档及 JSONL 数据）回答用户的问题。\n\n"
@@ -108,6 +139,10 @@ def make_answer_fn(rag: EmotionRAG, args):
             temperature=temperature,
             max_tokens=max_tokens,
         )
+        if cache is not None:
+            cache.store(
+                query_embedding, results["ids"][0], (content, context_md), cache_params
+            )
         return content, context_md
 
     return answer
@@ -116,6 +151,9 @@ def make_answer_fn(rag: EmotionRAG, args):
 def parse_args():
     parser = argparse.ArgumentParser(description="Gradio UI for EmotionRAG")
     parser.add_argument("--jsonl", type=str, default=None, help="JSONL 数据路径")
+    parser.add_argument(
+        "--user", type=str, default=None, help="用户 id，未提供 --jsonl 时读取该用户的图书馆"
+    )
     parser.add_argument(
         "--project",
         action="append",
@@ -141,6 +179,36 @@ def parse_args():
     )
     parser.add_argument("--chunk-size", type=int, default=800, help="分块大小")
     parser.add_argument("--chunk-overlap", type=int, default=200, help="分块重叠")
+    parser.add_argument(
+        "--context-budget",
+        type=int,
+        default=1500,
+        help="拼接进 prompt 的检索上下文 token 上限",
+    )
+    parser.add_argument(
+        "--cache-threshold",
+        type=float,
+        default=0.95,
+        help="语义缓存的余弦相似度阈值，<=0 关闭缓存",
+    )
+    parser.add_argument("--cache-size", type=int, default=256, help="语义缓存条目上限")
+    parser.add_argument(
+        "--no-watch",
+        action="store_true",
+        help="不追读 JSONL 新增卡片（默认运行期间自动入库）",
+    )
+    parser.add_argument(
+        "--watch-interval", type=float, default=1.0, help="追读新增卡片的轮询间隔（秒）"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=None, help="开启 Prometheus /metrics 端点的端口"
+    )
+    parser.add_argument(
+        "--metrics-dump", type=str, default=None, help="定期把指标快照写入该 JSON 文件"
+    )
+    parser.add_argument(
+        "--profile", type=str, default=None, help="运行期间做采样剖析，退出时把折叠栈写入该文件"
+    )
     parser.add_argument("--port", type=int, default=7860, help="Gradio 端口")
     parser.add_argument("--host", type=str, default="0.0.0.0", help="监听地址")
     parser.add_argument(
@@ -152,7 +220,23 @@ def parse_args():
 
 def main():
     args = parse_args()
+    if args.metrics_port:
+        tracing.start_metrics_server(args.metrics_port)
+    if args.metrics_dump:
+        tracing.start_json_dump(args.metrics_dump)
+    if args.profile:
+        profiler = tracing.SamplingProfiler().start()
+
+        def dump_profile():
+            profiler.stop()
+            profiler.dump(args.profile)
+            print(f"采样 {profiler.samples} 次，折叠栈已写入 {args.profile}")
+
+        # Ctrl+C 退出 launch 后写出
+        atexit.register(dump_profile)
     rag = build_rag(args)
+    if rag.jsonl_path and not args.no_watch:
+        CardTailer(rag, poll_interval=args.watch_interval).start()
     answer_fn = make_answer_fn(rag, args)
 
     with gr.Blocks(title=args.title) as demo:
@@ -173,6 +257,24 @@ def main():
             outputs=[answer_md, ctx_md],
         )
 
+        with gr.Accordion("情绪地形", open=False):
+            with gr.Row():
+                pattern = gr.Dropdown(
+                    ["消极", "积极", "激烈", "平静"], value="消极", label="情感模式"
+                )
+                narrate = gr.Checkbox(value=False, label="由模型叙述")
+            landscape_btn = gr.Button("查看")
+            landscape_md = gr.Markdown()
+            pattern_md = gr.Markdown()
+
+        def show_landscape(emotion_type: str, use_llm: bool):
+            report = rag.analyze_emotion_pattern(emotion_type, narrate=use_llm)
+            return rag.landscape.describe(), report.replace("\n", "  \n")
+
+        landscape_btn.click(
+            show_landscape, inputs=[pattern, narrate], outputs=[landscape_md, pattern_md]
+        )
+
     demo.launch(server_name=args.host, server_port=args.port, share=args.share)
 
 
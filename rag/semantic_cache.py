@@ -0,0 +1,128 @@
+"""
+语义回答缓存：问题向量足够相似、且检索到的卡片集合不变时，直接复用之前的回答。
+
+- 相似度为余弦相似度，阈值可配置
+- 监视 cards.jsonl 的大小与修改时间，文件变化时整体失效
+- LRU 淘汰，并统计命中率
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SemanticCache:
+    def __init__(
+        self,
+        threshold: float = 0.95,
+        max_entries: int = 256,
+        watch_path: str | None = None,
+    ):
+        """
+        Args:
+            threshold: 余弦相似度阈值，不低于该值视为同一问题
+            max_entries: 缓存条目上限，超出后淘汰最久未使用的条目
+            watch_path: 监视的数据文件（通常是 cards.jsonl），变化时清空缓存
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.watch_path = watch_path
+        self._entries: OrderedDict[int, dict] = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._signature = self._file_signature()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _file_signature(self):
+        if not self.watch_path:
+            return None
+        try:
+            st = os.stat(self.watch_path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    def _check_source(self):
+        signature = self._file_signature()
+        if signature != self._signature:
+            self._signature = signature
+            if self._entries:
+                self._entries.clear()
+                self.invalidations += 1
+
+    @staticmethod
+    def _normalize(embedding):
+        vec = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else vec
+
+    @staticmethod
+    def _key(card_ids, params):
+        return frozenset(card_ids), tuple(sorted((params or {}).items()))
+
+    def lookup(self, embedding, card_ids, params: dict | None = None):
+        """
+        查找缓存
+
+        Args:
+            embedding: 问题向量
+            card_ids: 本次检索到的文档 id（按集合比较，与顺序无关）
+            params: 影响回答的生成参数（top_k / temperature 等），需完全一致
+
+        Returns:
+            命中时返回缓存的回答，否则返回 None
+        """
+        vec = self._normalize(embedding)
+        key = self._key(card_ids, params)
+        with self._lock:
+            self._check_source()
+            best_id, best_sim = None, self.threshold
+            for entry_id, entry in self._entries.items():
+                if entry["key"] != key:
+                    continue
+                sim = float(np.dot(vec, entry["embedding"]))
+                if sim >= best_sim:
+                    best_id, best_sim = entry_id, sim
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id]["answer"]
+
+    def store(self, embedding, card_ids, answer, params: dict | None = None):
+        """写入一条缓存，超出上限时按 LRU 淘汰"""
+        with self._lock:
+            self._check_source()
+            self._entries[self._next_id] = {
+                "key": self._key(card_ids, params),
+                "embedding": self._normalize(embedding),
+                "answer": answer,
+            }
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
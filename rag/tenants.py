@@ -0,0 +1,351 @@
+"""
+多用户图书馆：每个用户一个 cards.jsonl 与一个向量集合，内存中只常驻最近使用的若干个。
+
+- 所有用户共享同一个向量模型与 Chroma 客户端
+- 按 LRU 淘汰：超过常驻数量或内存预算时，删除最久未使用用户的集合，下次访问再从磁盘重建
+- 常驻期间，其他进程追加到该用户文件的卡片在每次访问时增量补齐
+- 每次使用都持有租约（引用计数）：被淘汰的用户要等最后一个请求结束才真正删除集合
+- 建索引在注册表锁之外进行，同一用户的并发请求等待同一次加载
+- 本地预分类器（reply / local 模式）按用户各自的卡片训练，随该用户一起淘汰
+"""
+
+from __future__ import annotations
+
+import copy
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import chromadb
+from sentence_transformers import SentenceTransformer
+
+from rag.RAG_LM import EmotionRAG
+from rag.card_watcher import CardTailer
+from scripts.card_store import get_writer, make_card, user_cards_path
+from scripts.card_dedup import drop_index, rag_neighbor, screen_cards
+from scripts.tone_classifier import ToneClassifier
+
+
+class _LeasedStream:
+    """持有租约的回答流：读完、出错、close() 或被回收时归还，且只归还一次"""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._stream)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        try:
+            close = getattr(self._stream, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self._release()
+
+    def __del__(self):
+        self.close()
+
+
+class TenantRegistry:
+    def __init__(
+        self,
+        max_resident: int = 32,
+        max_memory_mb: float | None = 512,
+        embedding_model: str = "moka-ai/m3e-base",
+        context_budget: int = 1500,
+        dedup_embedding_threshold: float | None = None,
+    ):
+        """
+        Args:
+            max_resident: 同时常驻内存的用户索引数上限
+            max_memory_mb: 常驻索引的估算内存上限（MB），None 表示只按数量限制
+            embedding_model: 共享的中文向量化模型
+            context_budget: 每次问答的检索上下文 token 上限
+            dedup_embedding_threshold: 写入去重时额外做向量相似度检查的阈值，None 表示不做
+        """
+        self.max_resident = max_resident
+        self.embedding_model = embedding_model
+        self.max_memory = max_memory_mb * 1024 * 1024 if max_memory_mb else None
+        self.context_budget = context_budget
+        self.dedup_embedding_threshold = dedup_embedding_threshold
+
+        print("加载向量模型...")
+        self.embedder = SentenceTransformer(embedding_model)
+        self.dim = self.embedder.get_sentence_embedding_dimension()
+        self.chroma_client = chromadb.Client()
+
+        self._resident: OrderedDict[str | None, dict] = OrderedDict()
+        # 已淘汰但仍有请求在用的用户，租约全部归还后才删除集合
+        self._draining: dict[str | None, dict] = {}
+        # 正在加载的用户 -> Future，并发请求等待同一次加载
+        self._loading: dict[str | None, Future] = {}
+        self._lock = threading.RLock()
+        # 用户 -> 用其卡片训练好的预分类器；不强制加载向量索引，数量同样以 max_resident 为限
+        self._classifiers: OrderedDict[str | None, ToneClassifier] = OrderedDict()
+        self._classifier_base = None
+        self._classifier_lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def _estimate_bytes(self, count: int, texts) -> int:
+        """估算索引内存：向量（含 HNSW 图约 1.5 倍）+ 文档与元数据文本（约为文档的 2 倍）"""
+        text_bytes = sum(len(text.encode("utf-8")) * 2 for text in texts)
+        return int(count * self.dim * 4 * 1.5) + text_bytes
+
+    @staticmethod
+    def collection_name(user_id: str | None) -> str:
+        """
+        用户的向量集合名
+
+        默认图书馆使用固定名称；用户 id 取哈希，既不会与默认图书馆（或 id 为 "None" 的用户）
+        撞名，也总能满足 Chroma 对集合名的字符与长度限制。
+        """
+        if not user_id:
+            return "library_default"
+        return "u_" + hashlib.sha1(user_id.encode("utf-8")).hexdigest()[:16]
+
+    def _load(self, user_id: str | None) -> dict:
+        path = user_cards_path(user_id)
+        rag = EmotionRAG(
+            jsonl_path=path if os.path.exists(path) else None,
+            context_budget=self.context_budget,
+            collection_name=self.collection_name(user_id),
+            embedder=self.embedder,
+            chroma_client=self.chroma_client,
+        )
+        rag.jsonl_path = path
+        data = rag.collection.get(include=["documents"])
+        tenant = {
+            "rag": rag,
+            "tailer": CardTailer(rag, path),
+            "poll_lock": threading.Lock(),
+            "bytes": self._estimate_bytes(len(data["ids"]), data["documents"] or []),
+            "refs": 0,
+            "evicted": False,
+        }
+
+        def on_ingest(items):
+            texts = [rag._build_search_text(item) for item in items]
+            tenant["bytes"] += self._estimate_bytes(len(items), texts)
+
+        rag.ingest_listeners.append(on_ingest)
+        return tenant
+
+    def _evict_one(self):
+        user_id, tenant = self._resident.popitem(last=False)
+        self.evictions += 1
+        tenant["evicted"] = True
+        if tenant["refs"]:
+            # 仍有请求在检索或流式回答，等租约归还后再删除
+            self._draining[user_id] = tenant
+        else:
+            self._drop(user_id, tenant)
+
+    def _drop(self, user_id, tenant):
+        tenant["rag"].drop()
+        drop_index(user_cards_path(user_id))
+        self._classifiers.pop(user_id, None)
+        print(f"♻️ 释放用户 {user_id} 的索引（约 {tenant['bytes'] / 1024:.0f} KB）")
+
+    def _enforce_limits(self):
+        while len(self._resident) > 1 and (
+            len(self._resident) > self.max_resident
+            or (self.max_memory and self.memory_bytes() > self.max_memory)
+        ):
+            self._evict_one()
+
+    def _pin(self, user_id: str | None, load: bool = True) -> dict | None:
+        """
+        取得用户的租约（引用计数 +1），不在内存中时从磁盘加载
+
+        load=False 时只在用户常驻的情况下加租约，否则返回 None。
+        """
+        user_id = user_id or None
+        user_cards_path(user_id)  # 非法 id 在加载前就报错
+        while True:
+            with self._lock:
+                tenant = self._resident.get(user_id)
+                if tenant is None and user_id in self._draining:
+                    # 淘汰后还没来得及删除，直接恢复常驻
+                    tenant = self._resident[user_id] = self._draining.pop(user_id)
+                    tenant["evicted"] = False
+                if tenant is not None:
+                    self._resident.move_to_end(user_id)
+                    tenant["refs"] += 1
+                    break
+                if not load:
+                    return None
+                future = self._loading.get(user_id)
+                owner = future is None
+                if owner:
+                    future = self._loading[user_id] = Future()
+            if not owner:
+                # 另一个请求正在加载，等它完成后重新检查（可能已被淘汰）
+                future.result()
+                continue
+            try:
+                tenant = self._load(user_id)
+            except BaseException as e:
+                with self._lock:
+                    del self._loading[user_id]
+                future.set_exception(e)
+                raise
+            with self._lock:
+                del self._loading[user_id]
+                tenant["refs"] = 1
+                self._resident[user_id] = tenant
+                self.loads += 1
+                self._enforce_limits()
+            future.set_result(tenant)
+            return tenant
+
+        try:
+            with tenant["poll_lock"]:
+                tenant["tailer"].poll_once()
+        except BaseException:
+            self._unpin(user_id, tenant)
+            raise
+        with self._lock:
+            self._enforce_limits()
+        return tenant
+
+    def _unpin(self, user_id: str | None, tenant: dict):
+        user_id = user_id or None
+        with self._lock:
+            tenant["refs"] -= 1
+            if tenant["refs"] or not tenant["evicted"]:
+                return
+            if self._draining.get(user_id) is tenant:
+                del self._draining[user_id]
+        self._drop(user_id, tenant)
+
+    @contextmanager
+    def lease(self, user_id: str | None):
+        """在 with 块内使用用户的 RAG 实例，期间不会因淘汰而被删除"""
+        tenant = self._pin(user_id)
+        try:
+            yield tenant["rag"]
+        finally:
+            self._unpin(user_id, tenant)
+
+    def get(self, user_id: str | None) -> EmotionRAG:
+        """
+        取得（必要时加载）用户的 RAG 实例，用于预热
+
+        返回后不持有租约，实例随时可能被淘汰；需要使用时请用 lease()。
+        """
+        with self.lease(user_id) as rag:
+            return rag
+
+    def search(self, user_id: str, query: str, top_k: int = 3, valence_filter=None):
+        with self.lease(user_id) as rag:
+            return rag.search(query, top_k=top_k, valence_filter=valence_filter)
+
+    def query(self, user_id: str, question: str, top_k: int = 3, temperature: float = 0.7):
+        with self.lease(user_id) as rag:
+            return rag.query(question, top_k=top_k, temperature=temperature)
+
+    def query_stream(self, user_id: str, question: str, top_k: int = 3, temperature: float = 0.7,
+                     max_tokens: int | None = None):
+        """
+        流式问答；租约在调用时取得（非法 id 立即报错），回答流读完、关闭或被回收时归还
+
+        即使流从未开始迭代（如客户端在第一段之前断开），close() 与回收也会归还租约。
+        """
+        tenant = self._pin(user_id)
+        try:
+            stream = tenant["rag"].query_stream(
+                question, top_k=top_k, temperature=temperature, max_tokens=max_tokens
+            )
+        except BaseException:
+            self._unpin(user_id, tenant)
+            raise
+        return _LeasedStream(stream, lambda: self._unpin(user_id, tenant))
+
+    def classifier(self, user_id: str | None) -> ToneClassifier:
+        """
+        用该用户自己的卡片训练的本地预分类器，首次使用时训练
+
+        词表向量所有用户共用一份；用户被淘汰时一并丢弃，下次使用再按当时的卡片重新训练。
+        """
+        user_id = user_id or None
+        path = user_cards_path(user_id)
+        with self._classifier_lock:
+            clf = self._classifiers.get(user_id)
+            if clf is None:
+                if self._classifier_base is None:
+                    self._classifier_base = ToneClassifier(
+                        embedder=self.embedder, embedding_model=self.embedding_model
+                    )
+                clf = copy.copy(self._classifier_base).fit_from_cards(path)
+                self._classifiers[user_id] = clf
+                while len(self._classifiers) > self.max_resident:
+                    self._classifiers.popitem(last=False)
+            self._classifiers.move_to_end(user_id)
+            return clf
+
+    def save_card(self, user_id: str, raw_text: str, draft: dict) -> dict:
+        """写入用户的卡片文件；该用户常驻时同步更新其索引"""
+        cards, _ = self.save_cards(user_id, [(raw_text, draft)])
+        return cards[0]
+
+    def save_cards(self, user_id: str, items) -> tuple[list[dict], list[dict]]:
+        """
+        批量写入 (raw_text, draft)，整批只提交一次
+
+        写入前做重复检测（见 scripts.card_dedup），重复的卡片带 "duplicate_of"。
+
+        Returns:
+            (cards, kept)：cards 与 items 一一对应（含 skip 策略下被跳过的卡片），
+            kept 为实际写入的卡片
+        """
+        path = user_cards_path(user_id)
+        cards = [make_card(raw_text, draft) for raw_text, draft in items]
+        if self.dedup_embedding_threshold is not None:
+            with self.lease(user_id) as rag:
+                kept = screen_cards(
+                    path, cards, neighbor=rag_neighbor(rag), embedding_threshold=self.dedup_embedding_threshold
+                )
+        else:
+            kept = screen_cards(path, cards)
+        get_writer(path).append_many(kept)
+        # 该用户常驻时立即补齐索引；不常驻的下次加载时自然读到
+        tenant = self._pin(user_id, load=False)
+        if tenant is not None:
+            self._unpin(user_id, tenant)
+        return cards, kept
+
+    def memory_bytes(self) -> int:
+        return sum(t["bytes"] for t in self._resident.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "resident": len(self._resident),
+                "memory_mb": self.memory_bytes() / 1024 / 1024,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "draining": len(self._draining),
+                "users": {
+                    uid: {"cards": t["rag"].collection.count(), "bytes": t["bytes"]}
+                    for uid, t in self._resident.items()
+                },
+            }
@@ -0,0 +1,361 @@
+"""
+可复现的性能基准：卡片入库、检索、解析与端到端问答。
+
+- 按 emotion_schema.json 生成指定规模的合成 cards.jsonl（固定随机种子）
+- 测量 load_data 吞吐、search 的 p50/p99（有无 valence_filter）、
+  parse_model_output / aphasia_guard 吞吐，以及对本地模拟 OpenAI 服务的 query 延迟
+- 结果写为 JSON，可用 --compare 与上一次结果对比
+
+用法（在项目根目录）：
+python scripts/benchmark.py --sizes 1000,100000 --out bench.json
+python scripts/benchmark.py --sizes 1000 --embedder model --compare bench.json
+python scripts/benchmark.py --sizes 100000 --profile bench.folded   # 采样剖析，输出折叠栈
+
+默认使用哈希向量（--embedder hash），只衡量 IO、索引与检索本身；
+--embedder model 使用真实的 SentenceTransformer，规模大时会非常慢。
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+_ROOT = str(Path(__file__).resolve().parents[1])
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+from scripts import tracing  # noqa: E402
+from scripts.card_store import encode_card  # noqa: E402
+
+SCENES = [
+    "下雨天的出租车上", "图书馆靠窗的位置", "深夜的宿舍", "放学后的走廊", "地铁末班车",
+    "阳台晾衣服的时候", "排队买咖啡", "回家的公交站", "考试结束的下午", "周末的早市",
+]
+EVENTS = [
+    "突然想起你", "收到一条很久没联系的消息", "程序终于跑通了", "一个人吃完了晚饭",
+    "听到那首熟悉的歌", "看见一只瓢虫停在窗台", "被老师表扬了", "和朋友吵了一架",
+    "把旧照片翻出来看", "什么也没有发生",
+]
+TAILS = [
+    "心里空空的", "有点想哭", "整个人轻飘飘的", "说不清是什么感觉", "好像一切都会变好",
+    "胸口闷闷的", "只想安静地待一会儿", "笑得停不下来", "又不敢告诉任何人", "风很大",
+]
+QUERIES = [
+    "最消极的情感", "分析消极情绪", "下雨天的心情", "想念一个人", "程序跑通的喜悦",
+    "对比高唤醒和低唤醒的表达", "孤独的时候", "平静的午后",
+]
+SAMPLE_DRAFT = {
+    "summary": "用户在雨夜回想起一段旧事。",
+    "keywords": ["雨夜", "旧事"],
+    "spectrum": {"valence": -0.3, "arousal": 0.4, "tones": ["回声"]},
+    "thinking": "雨声与回忆叠加，情绪偏低但并不激烈。",
+    "metaphor_domain": "dust",
+    "metaphor_seed": 7,
+    "reply": "伞骨收拢的时候，有一页纸被轻轻夹进了书脊。我们都很想念那个快乐又悲伤的午后。",
+}
+SAMPLE_JSON = json.dumps({"draft": SAMPLE_DRAFT}, ensure_ascii=False)
+SAMPLE_REPLY = f"```json\n{SAMPLE_JSON}\n```"
+
+
+def _load_schema():
+    with open(os.path.join(_ROOT, "emotion_schema.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def generate_cards(n: int, path: str, seed: int = 42):
+    """生成 n 张与真实结构一致的合成卡片"""
+    rng = random.Random(seed)
+    schema = _load_schema()
+    quadrants = schema["tones_quadrants"]
+    domains_map = schema["domains_map"]
+    domains = schema["domains"]
+    base_ms = 1726000000000  # 2024-09 前后，覆盖多年以便日期相关测试
+    with open(path, "wb") as f:
+        for i in range(n):
+            valence = round(rng.uniform(-1, 1), 2)
+            arousal = round(rng.uniform(0, 1), 2)
+            v, a = ("neg" if valence < 0 else "pos"), ("high" if arousal >= 0.5 else "low")
+            domain = domains_map[f"{'low' if v == 'neg' else 'high'}V_{a}A"]
+            tones = rng.sample(quadrants[f"{v}_{a}"], 2)
+            images = rng.sample(domains[domain], 3)
+            raw = f"{rng.choice(SCENES)}，{rng.choice(EVENTS)}，{rng.choice(TAILS)}。" * rng.randint(1, 4)
+            card = {
+                "id": f"bench-{seed}-{i}",
+                "created_at": base_ms + i * 60_000 + rng.randint(0, 59_999),
+                "raw_text": raw,
+                "summary": f"用户记录了{rng.choice(EVENTS)}时的感受。",
+                "keywords": images[:2],
+                "spectrum": {"valence": valence, "arousal": arousal, "tones": tones},
+                "thinking": f"意象“{images[2]}”对应效价{valence}、唤醒度{arousal}。",
+                "metaphor_domain": domain,
+                "metaphor_seed": rng.randint(0, 99999),
+            }
+            f.write(encode_card(card))
+
+
+class HashEmbedder:
+    """确定性的字符二元组哈希向量，用来在不加载模型的情况下测量索引与检索开销"""
+
+    def __init__(self, dim: int = 128):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def _encode_one(self, text: str):
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for i in range(len(text) - 1):
+            h = int.from_bytes(hashlib.blake2b(text[i : i + 2].encode(), digest_size=4).digest(), "little")
+            vec[h % self.dim] += 1.0 if h & 1 else -1.0
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def encode(self, texts, **kwargs):
+        if isinstance(texts, str):
+            return self._encode_one(texts)
+        return np.stack([self._encode_one(t) for t in texts])
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        time.sleep(self.delay)
+        body = json.dumps(
+            {
+                "choices": [{"message": {"role": "assistant", "content": SAMPLE_REPLY}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0},
+            },
+            ensure_ascii=False,
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_mock_server(delay: float = 0.0):
+    """在本地随机端口启动一个 OpenAI-Compatible 的模拟服务，返回 (server, base_url)"""
+    handler = type("MockHandler", (_MockHandler,), {"delay": delay})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def _percentiles(samples: list[float]) -> dict | None:
+    """没有样本（如 --queries 0）时返回 None，与未测量的项一致"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {
+        "n": len(ordered),
+        "p50_ms": pick(0.50),
+        "p99_ms": pick(0.99),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+    }
+
+
+def _throughput(fn, items, repeat: int = 1) -> dict:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            fn(item)
+    elapsed = time.perf_counter() - start
+    total = len(items) * repeat
+    return {"n": total, "seconds": elapsed, "per_sec": total / elapsed if elapsed else 0.0}
+
+
+def bench_parsing(repeat: int = 2000) -> dict:
+    from scripts.chat_to_card import aphasia_guard, parse_model_output
+
+    samples = [SAMPLE_JSON, SAMPLE_REPLY, "好的，以下是结果：\n" + SAMPLE_REPLY]
+    replies = [SAMPLE_DRAFT["reply"]] * 3
+    return {
+        "parse_model_output": _throughput(parse_model_output, samples, repeat),
+        "aphasia_guard": _throughput(aphasia_guard, replies, repeat),
+    }
+
+
+def bench_rag(size: int, workdir: str, embedder, searches: int, queries: int, seed: int) -> dict:
+    from rag.RAG_LM import EmotionRAG
+
+    path = os.path.join(workdir, f"cards_{size}.jsonl")
+    start = time.perf_counter()
+    generate_cards(size, path, seed=seed)
+    gen_seconds = time.perf_counter() - start
+
+    rag = EmotionRAG(embedder=embedder, collection_name=f"bench_{size}")
+    start = time.perf_counter()
+    rag.load_data(path)
+    load_seconds = time.perf_counter() - start
+
+    rng = random.Random(seed)
+    plain, filtered = [], []
+    for i in range(searches):
+        q = rng.choice(QUERIES)
+        t0 = time.perf_counter()
+        rag.search(q, top_k=5)
+        plain.append(time.perf_counter() - t0)
+        lo = round(rng.uniform(-1, 0.5), 2)
+        t0 = time.perf_counter()
+        rag.search(q, top_k=5, valence_filter=(lo, lo + 0.5))
+        filtered.append(time.perf_counter() - t0)
+
+    server, base_url = start_mock_server()
+    rag.model_cfg = {"name": "mock", "base_url": base_url, "api_key": ""}
+    e2e = []
+    try:
+        for i in range(queries):
+            t0 = time.perf_counter()
+            rag.query(rng.choice(QUERIES), top_k=3)
+            e2e.append(time.perf_counter() - t0)
+    finally:
+        server.shutdown()
+    rag.drop()
+
+    return {
+        "cards": size,
+        "file_mb": os.path.getsize(path) / 1024 / 1024,
+        "generate_seconds": gen_seconds,
+        "load_data": {"seconds": load_seconds, "cards_per_sec": size / load_seconds},
+        "search": _percentiles(plain),
+        "search_valence_filter": _percentiles(filtered),
+        "query_e2e": _percentiles(e2e),
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=_ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, baseline: dict, tolerance: float = 0.10):
+    """对比两次结果中的 p50/p99 与吞吐，变差超过 tolerance 的项标记为回归"""
+    rows = []
+
+    def walk(cur, base, prefix):
+        for key, value in cur.items():
+            if key not in base:
+                continue
+            name = f"{prefix}.{key}" if prefix else key
+            if isinstance(value, dict) and isinstance(base[key], dict):
+                walk(value, base[key], name)
+            elif isinstance(value, (int, float)) and base[key]:
+                if key.endswith("_ms") or key == "seconds":
+                    ratio = value / base[key]
+                elif key.endswith("per_sec"):
+                    ratio = base[key] / value if value else float("inf")
+                else:
+                    continue
+                rows.append((name, base[key], value, ratio))
+
+    walk(current["results"], baseline["results"], "")
+    for name, old, new, ratio in rows:
+        flag = "⚠️ 回归" if ratio > 1 + tolerance else ""
+        print(f"{name:<60} {old:>12.3f} → {new:>12.3f}  x{ratio:.2f} {flag}")
+
+
+def _non_negative(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"应为非负整数: {value!r}")
+    return number
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Amnesia 性能基准")
+    parser.add_argument("--sizes", default="1000,100000", help="卡片规模，逗号分隔，如 1000,100000,1000000")
+    parser.add_argument("--embedder", choices=["hash", "model"], default="hash", help="向量模型")
+    parser.add_argument("--embedding-model", default="moka-ai/m3e-base", help="--embedder model 时使用的模型")
+    parser.add_argument("--searches", type=_non_negative, default=200, help="每个规模的检索次数")
+    parser.add_argument("--queries", type=_non_negative, default=20, help="每个规模的端到端问答次数，0 表示不测")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子")
+    parser.add_argument("--workdir", default=None, help="合成数据目录，默认临时目录")
+    parser.add_argument("--out", default="bench_output.json", help="结果 JSON 路径")
+    parser.add_argument("--compare", default=None, help="与之前的结果 JSON 对比")
+    parser.add_argument(
+        "--profile", default=None, help="运行期间做采样剖析，把折叠栈写入该文件（可用 flamegraph.pl 绘图）"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # chat_to_card 在导入时按相对路径读取提示词
+    os.chdir(_ROOT)
+
+    if args.embedder == "hash":
+        embedder = HashEmbedder()
+    else:
+        from sentence_transformers import SentenceTransformer
+
+        embedder = SentenceTransformer(args.embedding_model)
+
+    profiler = tracing.SamplingProfiler().start() if args.profile else None
+    results = {"parsing": bench_parsing()}
+    workdir = args.workdir or tempfile.mkdtemp(prefix="amnesia_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+        print(f"\n===== {size} 张卡片 =====")
+        results[f"rag_{size}"] = bench_rag(
+            size, workdir, embedder, args.searches, args.queries, args.seed
+        )
+    if profiler:
+        profiler.stop()
+        profiler.dump(args.profile)
+        print(f"\n采样 {profiler.samples} 次，折叠栈已写入 {args.profile}；热点：")
+        for frame, count in profiler.top(10):
+            print(f"  {count:6d}  {frame}")
+
+    report = {
+        "meta": {
+            "git": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "embedder": args.embedder,
+            "seed": args.seed,
+            "timestamp": int(time.time()),
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已写入 {args.out}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+"""
+按月分层存储卡片：cards.jsonl 只保留当月的热数据，已结束月份的卡片按 created_at
+移入 data/archive/YYYY-MM.jsonl（用户的卡片在 data/users/<id>/archive/），并维护一个小的 manifest.json。
+
+每张卡片只存一份：要么在某个月份分片里，要么还在 cards.jsonl 里。
+
+- sync：把 cards.jsonl 中已结束月份的卡片移入分片，并从 cards.jsonl 中删去；
+  get_writer 的写入在每次提交后自动检查（maybe_sync），换月后的第一次写入才会真正搬移
+- iter_archived：按月份顺序读取分片，需要完整历史的读取方（入库、追读重建、去重索引）先读它再读 cards.jsonl
+- query_range / on_this_day：只打开相关月份的分片（当月的卡片从 cards.jsonl 读）
+- compact：重写已封存的旧分片，去掉损坏行与重复 id，并按时间排序
+
+用法：
+python scripts/card_archive.py sync
+python scripts/card_archive.py range 2025-09-01 2025-10-01
+python scripts/card_archive.py today [MM-DD]
+python scripts/card_archive.py compact
+"""
+
+from __future__ import annotations
+
+import argparse
+import calendar
+import json
+import os
+import sys
+import threading
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+_ROOT = str(Path(__file__).resolve().parents[1])
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+from scripts.card_store import (  # noqa: E402
+    DEFAULT_PATH,
+    file_identity,
+    CardWriter,
+    decode_card,
+    encode_card,
+    file_lock,
+    iter_cards,
+    iter_cards_from,
+)
+
+DEFAULT_ARCHIVE = os.path.join("data", "archive")
+
+
+def _month_day(day) -> tuple[int, int]:
+    """把 "MM-DD"、(月, 日) 或日期解析为 (月, 日)，不绑定具体年份，02-29 合法"""
+    if day is None:
+        day = datetime.now()
+    if isinstance(day, str):
+        try:
+            month, mday = (int(part) for part in day.split("-"))
+        except ValueError:
+            raise ValueError(f"日期格式应为 MM-DD: {day!r}")
+    elif isinstance(day, tuple):
+        month, mday = day
+    else:
+        month, mday = day.month, day.day
+    # 用闰年校验，2 月 29 日总是合法
+    if not 1 <= month <= 12 or not 1 <= mday <= calendar.monthrange(2000, month)[1]:
+        raise ValueError(f"不存在的日期: {month:02d}-{mday:02d}")
+    return month, mday
+
+
+def _card_datetime(card: dict) -> datetime | None:
+    created_at = card.get("created_at")
+    if not isinstance(created_at, (int, float)) or created_at <= 0:
+        return None
+    return datetime.fromtimestamp(created_at / 1000)
+
+
+def _to_datetime(value) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000)
+    return datetime.fromisoformat(str(value))
+
+
+def _month_key(dt: datetime) -> str:
+    return f"{dt.year:04d}-{dt.month:02d}"
+
+
+def _iter_months(start: datetime, end: datetime):
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        yield f"{year:04d}-{month:02d}"
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+
+
+def archive_root(path: str) -> str:
+    """cards.jsonl 对应的分片目录：与它同目录下的 archive/（默认即 data/archive）"""
+    return os.path.join(os.path.dirname(path), "archive")
+
+
+class CardArchive:
+    def __init__(self, root: str | None = None, source: str | None = DEFAULT_PATH):
+        """
+        Args:
+            root: 分片目录，默认为 source 旁边的 archive/
+            source: 热文件 cards.jsonl；为 None 时不自动归档
+        """
+        self.root = root or archive_root(source or DEFAULT_PATH)
+        self.source = source
+        self.manifest_path = os.path.join(self.root, "manifest.json")
+        self.lock_path = os.path.join(self.root, "manifest.lock")
+        # 本进程已确认过的 (热文件 inode, 月份)，写入路径据此跳过检查
+        self._synced = None
+
+    # ---------- manifest ----------
+
+    def load_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            manifest = {}
+        manifest.setdefault("shards", {})
+        return manifest
+
+    def _save_manifest(self, manifest: dict):
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp, self.manifest_path)
+
+    def shard_path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.jsonl")
+
+    # ---------- 写入 ----------
+
+    def _append_to_shards(self, manifest: dict, by_month: dict[str, list[dict]]) -> int:
+        """
+        写入各月分片并按分片实际内容更新 manifest
+
+        已在分片中的 id 不重复写：上次归档写完分片、没来得及裁剪热文件就中断时，这里会重放。
+        """
+        count = 0
+        for key, batch in by_month.items():
+            path = self.shard_path(key)
+            archived = list(iter_cards(path))
+            known = {card.get("id") for card in archived}
+            batch = [card for card in batch if card.get("id") not in known]
+            if batch:
+                CardWriter(path, durability="fsync", group_commit=False).append_many(batch)
+                count += len(batch)
+            stamps = [c["created_at"] for c in archived + batch]
+            manifest["shards"][key] = {
+                "count": len(stamps),
+                "min_created_at": min(stamps),
+                "max_created_at": max(stamps),
+                "compacted": False,
+            }
+        return count
+
+    def sync(self) -> int:
+        """
+        把热文件中已结束月份的卡片移入分片，并从热文件中删去，返回移动的卡片数
+
+        在热文件的写锁内进行：先 fsync 分片，再用只含当月卡片的新文件原子替换热文件。
+        替换后 inode 改变，追读方（CardTailer、DedupIndex）会连同分片一起重新对齐。
+        """
+        if not self.source or not os.path.exists(self.source):
+            return 0
+        month = _month_key(datetime.now())
+        with file_lock(self.lock_path), file_lock(self.source):
+            manifest = self.load_manifest()
+            by_month: dict[str, list[dict]] = {}
+            tmp = self.source + ".archive"
+            with open(self.source, "rb") as f, open(tmp, "wb") as out:
+                for raw in f:
+                    card = decode_card(raw)
+                    dt = _card_datetime(card) if card else None
+                    if dt is not None and _month_key(dt) < month:
+                        by_month.setdefault(_month_key(dt), []).append(card)
+                    else:
+                        # 当月、没有时间戳或无法解析的行原样保留
+                        out.write(raw)
+                out.flush()
+                os.fsync(out.fileno())
+            if by_month:
+                count = self._append_to_shards(manifest, by_month)
+                os.replace(tmp, self.source)
+            else:
+                count = 0
+                os.remove(tmp)
+            identity = list(file_identity(self.source))
+            manifest["hot"] = {"identity": identity, "month": month}
+            self._save_manifest(manifest)
+        self._synced = (tuple(identity), month)
+        return count
+
+    def maybe_sync(self) -> int:
+        """
+        写入路径上的检查：热文件自上次归档后没有换月、也没有被替换时什么都不做
+
+        进程内只需一次 stat；换月后的第一次写入才会真正搬移卡片。
+        """
+        if not self.source:
+            return 0
+        identity = file_identity(self.source)
+        month = _month_key(datetime.now())
+        if identity is None or self._synced == (identity, month):
+            return 0
+        if self.load_manifest().get("hot") == {"identity": list(identity), "month": month}:
+            self._synced = (identity, month)
+            return 0
+        return self.sync()
+
+    # ---------- 查询 ----------
+
+    def _read_shard(self, key: str):
+        yield from iter_cards(self.shard_path(key))
+
+    def query_range(self, start, end, sync: bool = True) -> list[dict]:
+        """
+        查询 [start, end) 区间内的卡片，按 created_at 排序
+
+        Args:
+            start / end: datetime、date、毫秒时间戳或 ISO 日期字符串
+        """
+        if sync:
+            self.maybe_sync()
+        start_dt, end_dt = _to_datetime(start), _to_datetime(end)
+        start_ms, end_ms = start_dt.timestamp() * 1000, end_dt.timestamp() * 1000
+        manifest = self.load_manifest()
+        shards = manifest["shards"]
+        sources = [
+            self.shard_path(key)
+            for key in _iter_months(start_dt, end_dt - timedelta(microseconds=1))
+            if key in shards
+        ]
+        hot = manifest.get("hot")
+        # 热文件只含归档时的当月及之后的卡片；区间在那之前结束时不必读它
+        if self.source and (hot is None or end_dt > datetime.strptime(hot["month"], "%Y-%m")):
+            sources.append(self.source)
+        out, seen = [], set()
+        for path in sources:
+            for card in iter_cards(path):
+                created_at = card.get("created_at")
+                if not isinstance(created_at, (int, float)) or card.get("id") in seen:
+                    continue
+                if start_ms <= created_at < end_ms:
+                    seen.add(card.get("id"))
+                    out.append(card)
+        out.sort(key=lambda c: c["created_at"])
+        return out
+
+    def on_this_day(self, day=None, sync: bool = True) -> dict[int, list[dict]]:
+        """
+        “去年今日”：返回往年同月同日的卡片，按年份分组（不含当年）
+
+        Args:
+            day: "MM-DD" 字符串、(月, 日)，或 datetime / date（只取月日）；默认今天
+
+        每个往年只打开一个月份分片；往年的卡片都已移出 cards.jsonl，不必读它。2 月 29 日的卡片只在闰年有对应的日子，
+        因此在平年的 2 月 28 日一并返回。
+        """
+        if sync:
+            self.maybe_sync()
+        this_year = datetime.now().year
+        month, mday = _month_day(day)
+        days = {mday}
+        if (month, mday) == (2, 28) and not calendar.isleap(this_year):
+            days.add(29)
+        shards = self.load_manifest()["shards"]
+        out: dict[int, list[dict]] = {}
+        seen = set()
+        for key in sorted(shards):
+            year, shard_month = key.split("-")
+            if int(shard_month) != month or int(year) >= this_year:
+                continue
+            for card in self._read_shard(key):
+                dt = _card_datetime(card)
+                if dt and dt.day in days and card.get("id") not in seen:
+                    seen.add(card.get("id"))
+                    out.setdefault(int(year), []).append(card)
+        for cards in out.values():
+            cards.sort(key=lambda c: c["created_at"])
+        return out
+
+    # ---------- 压缩 ----------
+
+    def compact(self, before=None) -> dict:
+        """
+        重写 before 所在月份之前的分片：去掉损坏行和重复 id、按时间排序
+
+        当前月份的分片仍在写入，默认不压缩。
+        """
+        before_key = _month_key(_to_datetime(before) if before else datetime.now())
+        report = {}
+        with file_lock(self.lock_path):
+            manifest = self.load_manifest()
+            for key, info in sorted(manifest["shards"].items()):
+                if key >= before_key or info.get("compacted"):
+                    continue
+                path = self.shard_path(key)
+                cards, seen = [], set()
+                for card in iter_cards(path):
+                    if card.get("id") in seen:
+                        continue
+                    seen.add(card.get("id"))
+                    cards.append(card)
+                cards.sort(key=lambda c: c["created_at"])
+                tmp = path + ".tmp"
+                with open(tmp, "wb") as f:
+                    f.writelines(encode_card(card) for card in cards)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, path)
+                report[key] = {"before": info["count"], "after": len(cards)}
+                info["count"] = len(cards)
+                info["compacted"] = True
+            self._save_manifest(manifest)
+        return report
+
+
+def iter_archived(path: str = DEFAULT_PATH, batch_size: int = 1000):
+    """
+    按月份顺序逐批读取 path 已移入分片的卡片，没有归档时什么也不产出
+
+    完整历史 = iter_archived(path) + iter_cards_from(path)。
+    """
+    archive = CardArchive(source=path)
+    for key in sorted(archive.load_manifest()["shards"]):
+        shard = archive.shard_path(key)
+        if not os.path.exists(shard):
+            continue
+        for cards, _ in iter_cards_from(shard, batch_size=batch_size):
+            if cards:
+                yield cards
+
+
+_archives: dict[str, CardArchive] = {}
+_archives_lock = threading.Lock()
+
+
+def sync_after_commit(path: str):
+    """CardWriter 的提交回调（见 card_store.get_writer）：换月后把上月的卡片移出热文件"""
+    key = os.path.abspath(path)
+    with _archives_lock:
+        archive = _archives.get(key)
+        if archive is None:
+            archive = _archives[key] = CardArchive(source=path)
+    try:
+        moved = archive.maybe_sync()
+    except Exception as e:
+        # 归档失败不影响已经写入的卡片，下次提交再试
+        print(f"警告：归档 {path} 失败: {e}")
+        return
+    if moved:
+        print(f"🗄️ 已把 {moved} 张往月卡片移入 {archive.root}")
+
+
+def _print_cards(cards):
+    for c in cards:
+        dt = _card_datetime(c)
+        print(f"[{dt:%Y-%m-%d %H:%M}] {c.get('raw_text', '')[:40]}  tones={c.get('spectrum', {}).get('tones', [])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按月分片的卡片归档")
+    parser.add_argument("--source", default=DEFAULT_PATH, help="cards.jsonl 路径")
+    parser.add_argument("--root", default=None, help="分片目录，默认为 cards.jsonl 旁边的 archive/")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("sync", help="把 cards.jsonl 中往月的卡片移入分片")
+    p_range = sub.add_parser("range", help="查询日期区间 [start, end)")
+    p_range.add_argument("start")
+    p_range.add_argument("end")
+    p_today = sub.add_parser("today", help="去年今日")
+    p_today.add_argument("day", nargs="?", help="MM-DD，默认今天")
+    sub.add_parser("compact", help="压缩已封存的旧分片")
+    args = parser.parse_args()
+
+    try:
+        if args.cmd == "range":
+            _to_datetime(args.start), _to_datetime(args.end)
+        elif args.cmd == "today":
+            _month_day(args.day)
+    except ValueError as e:
+        parser.error(f"{e}（range 用 YYYY-MM-DD，today 用 MM-DD）")
+
+    archive = CardArchive(args.root, args.source)
+    if args.cmd == "sync":
+        print(f"移入分片 {archive.sync()} 张卡片")
+    elif args.cmd == "range":
+        _print_cards(archive.query_range(args.start, args.end))
+    elif args.cmd == "today":
+        for year, cards in archive.on_this_day(args.day).items():
+            print(f"—— {year} ——")
+            _print_cards(cards)
+    elif args.cmd == "compact":
+        for key, info in archive.compact().items():
+            print(f"{key}: {info['before']} → {info['after']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,507 @@
+"""
+写入前的近似重复检测：精确哈希 + raw_text 的 MinHash LSH + 可选的向量相似度。
+
+- 精确：规范化（NFKC、小写、去空白与标点）后的 sha1，O(1) 查表；
+  规范化后几乎不剩内容的文本（纯表情、纯标点）改用原文的 sha1，且不做近似检查
+- 近似：字符 2-gram 的 MinHash 签名分段入桶（LSH），只与同桶候选比较签名
+- 向量：可选，前两步未命中时再用已有向量索引查最近邻（见 rag_neighbor）
+
+索引会定期写入旁路文件 <cards.jsonl>.dedup.npz（记录读到的字节偏移与文件 inode），
+新进程从旁路文件恢复后只追读之后的新卡片，不必每次从整个存档重建。
+
+命中后按策略处理（环境变量 CARD_DEDUP，默认 link）：
+  link —— 照常写入，但卡片带 "duplicate_of"，入库检索时跳过
+  skip —— 不写入
+  off  —— 不检测
+
+用法（整理已有存档，一次性）：
+python scripts/card_dedup.py compact --policy skip
+python scripts/card_dedup.py check "我想你"
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import sys
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+_ROOT = str(Path(__file__).resolve().parents[1])
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+from scripts.card_archive import iter_archived  # noqa: E402
+from scripts.card_store import (  # noqa: E402
+    DEFAULT_PATH,
+    encode_card,
+    file_identity,
+    file_lock,
+    iter_cards,
+    iter_cards_from,
+)
+from scripts import tracing  # noqa: E402
+
+DEDUP_POLICIES = ("link", "skip", "off")
+
+_STRIP_PATTERN = re.compile(r"[\s\W_]+", re.UNICODE)
+# 规范化后短于此长度的文本不参与规范化比较，否则 "😭" 与 "？？" 都会变成空串而互判重复
+_MIN_NORMALIZED_LEN = 2
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return _STRIP_PATTERN.sub("", text)
+
+
+def _too_short(text: str) -> bool:
+    return len(normalize_text(text)) < _MIN_NORMALIZED_LEN
+
+
+def exact_key(text: str) -> str:
+    if _too_short(text):
+        # 只去掉首尾空白，按原文比较
+        key = "raw:" + unicodedata.normalize("NFKC", text or "").strip()
+    else:
+        key = normalize_text(text)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def shingles(text: str, k: int = 2) -> set[bytes]:
+    """字符 k-gram；中文短句用 2-gram 已足够区分"""
+    text = normalize_text(text)
+    if len(text) <= k:
+        return {text.encode("utf-8")} if text else set()
+    return {text[i : i + k].encode("utf-8") for i in range(len(text) - k + 1)}
+
+
+class MinHasher:
+    """乘移位哈希族的 MinHash：h(x) = ((a·x + b) mod 2⁶⁴) >> 32"""
+
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.randint(0, 2**63, size=num_perm, dtype=np.uint64)
+        self.num_perm = num_perm
+
+    def signature(self, text: str):
+        grams = shingles(text)
+        sig = np.full(self.num_perm, np.iinfo(np.uint32).max, dtype=np.uint32)
+        if not grams:
+            return sig
+        x = np.array([zlib.crc32(g) for g in grams], dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            hashed = (x[:, None] * self.a[None, :] + self.b[None, :]) >> np.uint64(32)
+        return hashed.min(axis=0).astype(np.uint32)
+
+
+class DedupIndex:
+    # 从文件新读入这么多张卡片后写一次旁路文件；未写入的部分下次多追读几行即可
+    SAVE_EVERY = 256
+
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        num_perm: int = 64,
+        bands: int = 16,
+        neighbor=None,
+        embedding_threshold: float = 0.95,
+    ):
+        """
+        Args:
+            threshold: MinHash 估计的 Jaccard 相似度阈值
+            num_perm / bands: 签名长度与 LSH 分段数（每段 num_perm // bands 行）
+            neighbor: 可选，neighbor(card) -> (id, 余弦相似度) 或 None，用于向量检查
+            embedding_threshold: 向量检查的相似度阈值
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm 必须能被 bands 整除")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        # 每段签名压成一个 64 位整数作为桶键；偶发碰撞只会多出候选，最终仍按签名比较
+        self._band_mult = np.random.RandomState(2).randint(1, 2**63, size=self.rows, dtype=np.uint64) | np.uint64(1)
+        self.neighbor = neighbor
+        self.embedding_threshold = embedding_threshold
+
+        self.exact: dict[str, str] = {}
+        self.signatures: dict[str, np.ndarray] = {}
+        # 增量登记的卡片：(段号, 桶键) -> id 列表
+        self.buckets: dict[tuple[int, int], list[str]] = {}
+        # 从旁路文件恢复的卡片：每段按桶键排好序，二分查找候选
+        self._frozen_ids: list[str] = []
+        self._frozen_keys = None
+        self._frozen_order = None
+        # 规范化后过短、没有入桶的卡片
+        self.short: set[str] = set()
+        self.path = None
+        self.identity = None
+        self.offset = 0
+        self._unsaved = 0
+        self._lock = threading.Lock()
+
+    def _band_hashes(self, signatures):
+        """(n, num_perm) 的签名 -> (n, bands) 的桶键"""
+        parts = signatures.reshape(len(signatures), self.bands, self.rows).astype(np.uint64)
+        with np.errstate(over="ignore"):
+            return (parts * self._band_mult).sum(axis=2, dtype=np.uint64)
+
+    def _candidates(self, sig) -> set[str]:
+        keys = self._band_hashes(sig[None, :])[0]
+        candidates = set()
+        for band, key in enumerate(keys.tolist()):
+            candidates.update(self.buckets.get((band, key), ()))
+        if self._frozen_keys is not None:
+            for band, key in enumerate(keys):
+                row = self._frozen_keys[band]
+                lo, hi = np.searchsorted(row, key, "left"), np.searchsorted(row, key, "right")
+                candidates.update(self._frozen_ids[i] for i in self._frozen_order[band, lo:hi])
+        return candidates
+
+    def check(self, card: dict):
+        """
+        查找与 card 重复的已有卡片
+
+        Returns:
+            {"kind": "exact" | "minhash" | "embedding", "id": 已有卡片 id, "score": 相似度}，未命中为 None
+        """
+        text = card.get("raw_text", "")
+        key = exact_key(text)
+        if key in self.exact:
+            return {"kind": "exact", "id": self.exact[key], "score": 1.0}
+        if _too_short(text):
+            return None
+
+        sig = self.hasher.signature(text)
+        best = None
+        for cid in self._candidates(sig):
+            score = float(np.mean(self.signatures[cid] == sig))
+            if score >= self.threshold and (best is None or score > best["score"]):
+                best = {"kind": "minhash", "id": cid, "score": score}
+        if best is not None:
+            return best
+
+        if self.neighbor is not None:
+            hit = self.neighbor(card)
+            if hit is not None and hit[1] >= self.embedding_threshold:
+                return {"kind": "embedding", "id": hit[0], "score": float(hit[1])}
+        return None
+
+    def add(self, card: dict):
+        """登记一张卡片；已标记为重复的卡片不登记，始终以最早的那张为准"""
+        cid = card.get("id")
+        if not cid or card.get("duplicate_of") or cid in self.signatures:
+            return
+        text = card.get("raw_text", "")
+        self.exact.setdefault(exact_key(text), cid)
+        sig = self.hasher.signature(text)
+        self.signatures[cid] = sig
+        if _too_short(text):
+            # 签名几乎为空，入桶只会和其他短文本互相命中
+            self.short.add(cid)
+            return
+        for band, key in enumerate(self._band_hashes(sig[None, :])[0].tolist()):
+            self.buckets.setdefault((band, key), []).append(cid)
+
+    def refresh(self, path: str):
+        """从上次读到的偏移继续，登记其他进程新写入的卡片"""
+        identity = file_identity(path)
+        if identity is None:
+            return
+        if self.path != path or self.identity != identity or os.path.getsize(path) < self.offset:
+            # 换了文件、文件被替换（compact、按月归档）或被截断：先尝试旁路文件，
+            # 否则连同已归档的往月卡片从头建立
+            self.path, self.identity, self.offset = path, identity, 0
+            self.exact.clear()
+            self.signatures.clear()
+            self.buckets.clear()
+            self.short.clear()
+            self._frozen_ids, self._frozen_keys, self._frozen_order = [], None, None
+            self._unsaved = 0
+            if not self._load_sidecar():
+                for cards in iter_archived(path):
+                    for card in cards:
+                        self.add(card)
+                    self._unsaved += len(cards)
+        for cards, self.offset in iter_cards_from(path, self.offset):
+            for card in cards:
+                self.add(card)
+            self._unsaved += len(cards)
+        if self._unsaved >= self.SAVE_EVERY:
+            self.save()
+
+    @staticmethod
+    def sidecar_path(path: str) -> str:
+        return path + ".dedup.npz"
+
+    def save(self):
+        """
+        把索引与已读到的偏移写入旁路文件
+
+        其中也可能包含本进程刚登记、尚未落盘的卡片；它们之后写在偏移之后，重读时按 id 忽略。
+        """
+        if self.path is None:
+            return
+        ids = list(self.signatures)
+        if ids:
+            signatures = np.stack([self.signatures[cid] for cid in ids])
+        else:
+            signatures = np.zeros((0, self.hasher.num_perm), dtype=np.uint32)
+        sidecar = self.sidecar_path(self.path)
+        tmp = sidecar + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                np.savez(
+                    f,
+                    ids=np.array(ids, dtype=str),
+                    signatures=signatures,
+                    short=np.array([cid in self.short for cid in ids], dtype=bool),
+                    exact_keys=np.array(list(self.exact), dtype=str),
+                    exact_ids=np.array(list(self.exact.values()), dtype=str),
+                    offset=np.int64(self.offset),
+                    identity=np.array(self.identity, dtype=np.int64),
+                    params=np.array([self.hasher.num_perm, self.bands], dtype=np.int64),
+                )
+            os.replace(tmp, sidecar)
+        except OSError as e:
+            print(f"警告：写入去重索引 {sidecar} 失败: {e}")
+            return
+        self._unsaved = 0
+
+    def _load_sidecar(self):
+        """从旁路文件恢复到它记录的偏移，返回是否成功；它属于被替换前的文件或参数不同时忽略"""
+        try:
+            with np.load(self.sidecar_path(self.path)) as data:
+                offset = int(data["offset"])
+                if (
+                    tuple(int(x) for x in data["identity"]) != tuple(self.identity)
+                    or tuple(int(x) for x in data["params"]) != (self.hasher.num_perm, self.bands)
+                    or offset > os.path.getsize(self.path)
+                ):
+                    return False
+                ids = data["ids"].tolist()
+                signatures = data["signatures"]
+                short = data["short"]
+                exact = zip(data["exact_keys"].tolist(), data["exact_ids"].tolist())
+                self.exact.update(exact)
+        except (OSError, ValueError, KeyError):
+            return False
+        self.signatures.update(zip(ids, signatures))
+        self.short.update(ids[i] for i in np.flatnonzero(short))
+        # 整批向量化建桶：按段排序后查询时二分
+        keep = np.flatnonzero(~short)
+        self._frozen_ids = [ids[i] for i in keep]
+        hashes = self._band_hashes(signatures[keep]).T
+        self._frozen_order = np.argsort(hashes, axis=1, kind="stable")
+        self._frozen_keys = np.take_along_axis(hashes, self._frozen_order, axis=1)
+        self.offset = offset
+        return True
+
+    def __len__(self):
+        return len(self.signatures)
+
+
+def current_policy(policy: str | None = None) -> str:
+    policy = (policy or os.getenv("CARD_DEDUP", "link")).lower()
+    if policy not in DEDUP_POLICIES:
+        raise ValueError(f"未知的去重策略 {policy!r}，可选 {DEDUP_POLICIES}")
+    return policy
+
+
+# 同一进程内最多常驻的索引数（多用户服务），超出时按 LRU 释放
+MAX_INDEXES = 32
+
+_indexes: OrderedDict[str, DedupIndex] = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _release(index: DedupIndex):
+    with index._lock:
+        if index._unsaved:
+            index.save()
+
+
+def get_index(path: str = DEFAULT_PATH) -> DedupIndex:
+    """同一进程内按路径共享 DedupIndex，首次使用时从旁路文件或存档建立"""
+    key = os.path.abspath(path)
+    evicted = []
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = DedupIndex()
+        _indexes.move_to_end(key)
+        while len(_indexes) > MAX_INDEXES:
+            evicted.append(_indexes.popitem(last=False)[1])
+    for old in evicted:
+        _release(old)
+    return index
+
+
+def drop_index(path: str):
+    """释放某个路径的共享 DedupIndex（多用户服务在淘汰该用户时调用），下次使用时从旁路文件恢复"""
+    with _indexes_lock:
+        index = _indexes.pop(os.path.abspath(path), None)
+    if index is not None:
+        _release(index)
+
+
+def screen_cards(
+    path: str,
+    cards: list[dict],
+    policy: str | None = None,
+    neighbor=None,
+    embedding_threshold: float | None = None,
+) -> list[dict]:
+    """
+    写入前检查一批卡片，返回应写入的卡片
+
+    命中的卡片会被加上 "duplicate_of"（调用方可据此提示用户）；
+    link 策略下它们仍会写入，skip 策略下被丢弃。同一批内互相重复也能识别。
+    neighbor 见 rag_neighbor，仅在本次调用中生效。
+    """
+    policy = current_policy(policy)
+    if policy == "off":
+        return list(cards)
+    index = get_index(path)
+    kept = []
+    with index._lock:
+        index.refresh(path)
+        index.neighbor = neighbor
+        if embedding_threshold is not None:
+            index.embedding_threshold = embedding_threshold
+        try:
+            for card in cards:
+                match = index.check(card)
+                if match is None:
+                    index.add(card)
+                    kept.append(card)
+                    continue
+                card["duplicate_of"] = match["id"]
+                tracing.incr("cards_duplicates_total", kind=match["kind"], policy=policy)
+                print(f"🔁 与已有记忆 {match['id']} 重复（{match['kind']}，{match['score']:.2f}）")
+                if policy == "link":
+                    kept.append(card)
+        finally:
+            index.neighbor = None
+    return kept
+
+
+def rag_neighbor(rag, candidates: int = 3):
+    """
+    用 EmotionRAG 的向量索引做最近邻检查：按 raw_text 检索若干候选，
+    再把候选的 raw_text 与新文本一起向量化，取最大余弦相似度
+    """
+
+    def neighbor(card):
+        text = card.get("raw_text", "")
+        if not text or rag.collection is None or rag.collection.count() == 0:
+            return None
+        results = rag.collection.query(
+            query_embeddings=[rag.embed(text)],
+            n_results=candidates,
+            where={"source": "jsonl"},
+        )
+        ids = results["ids"][0]
+        if not ids:
+            return None
+        texts = [meta.get("raw_text", "") for meta in results["metadatas"][0]]
+        vectors = np.asarray(rag.embed([text] + texts), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        sims = vectors[1:] @ vectors[0]
+        best = int(np.argmax(sims))
+        return ids[best], float(sims[best])
+
+    return neighbor
+
+
+def compact(path: str = DEFAULT_PATH, policy: str = "skip", dry_run: bool = False, threshold: float = 0.8) -> dict:
+    """
+    一次性整理已有存档：按时间顺序保留每组重复中最早的一张
+
+    在文件锁内写出新文件再原子替换（原文件备份为 .bak）。替换后文件的 inode 改变：
+    写入进程等到锁后会改为追加到新文件，追读方（CardTailer、DedupIndex）
+    据此从头重建，不会保留被删除的重复卡片。
+    link 只给重复卡片补上 duplicate_of；skip 直接删除它们。
+    已移入按月分片的往月卡片不改写，只作为比对基准（分片本身用 card_archive compact 整理）。
+    """
+    if policy not in ("link", "skip"):
+        raise ValueError("compact 只支持 link / skip")
+    index = DedupIndex(threshold=threshold)
+    stats = {"total": 0, "duplicates": 0, "exact": 0, "minhash": 0, "linked": 0}
+    for cards in iter_archived(path):
+        for card in cards:
+            index.add(card)
+    with file_lock(path):
+        lines = []
+        for card in iter_cards(path):
+            stats["total"] += 1
+            if card.get("duplicate_of"):
+                # 之前按 link 策略写入的重复卡片
+                stats["duplicates"] += 1
+                stats["linked"] += 1
+                if policy == "link":
+                    lines.append(encode_card(card))
+                continue
+            match = index.check(card)
+            if match is not None:
+                stats["duplicates"] += 1
+                stats[match["kind"]] += 1
+                if policy == "skip":
+                    continue
+                card["duplicate_of"] = match["id"]
+            else:
+                index.add(card)
+            lines.append(encode_card(card))
+        if dry_run:
+            return stats
+        backup = path + ".bak"
+        shutil.copyfile(path, backup)
+        tmp = path + ".compact"
+        with open(tmp, "wb") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    print(f"原文件已备份到 {backup}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="卡片近似重复检测")
+    parser.add_argument("--path", default=DEFAULT_PATH, help="cards.jsonl 路径")
+    parser.add_argument("--threshold", type=float, default=0.8, help="MinHash Jaccard 阈值")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_compact = sub.add_parser("compact", help="整理已有存档中的重复卡片")
+    p_compact.add_argument("--policy", choices=("link", "skip"), default="skip")
+    p_compact.add_argument("--dry-run", action="store_true", help="只统计，不改写文件")
+    p_check = sub.add_parser("check", help="检查一段文本是否与存档重复")
+    p_check.add_argument("text")
+    args = parser.parse_args()
+
+    if args.cmd == "compact":
+        stats = compact(args.path, policy=args.policy, dry_run=args.dry_run, threshold=args.threshold)
+        print(
+            f"共 {stats['total']} 张，重复 {stats['duplicates']} 张"
+            f"（精确 {stats['exact']}，近似 {stats['minhash']}，此前已关联 {stats['linked']}）"
+        )
+    elif args.cmd == "check":
+        index = DedupIndex(threshold=args.threshold)
+        index.refresh(args.path)
+        match = index.check({"raw_text": args.text})
+        if match is None:
+            print("未发现重复")
+        else:
+            print(f"与 {match['id']} 重复（{match['kind']}，{match['score']:.2f}）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+"""
+cards.jsonl 追加写入：文件锁 + 组提交 + 可配置持久化级别 + 每行校验和。
+
+- 多个进程（chat_to_card、input 批量导入、UI）同时写入时，整行在文件锁内一次写完，不会交错
+- 组提交：后台线程把排队的多张卡片合并成一次 write + fsync
+- 每行带 "crc" 字段（去掉该字段后的 JSON 的 CRC32），读取端据此跳过损坏或未写完的行
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+
+# 持久化级别（每次提交都会在文件锁内写到操作系统，保证行不交错）：
+#   os       —— 由操作系统决定何时落盘，进程崩溃不丢，掉电可能丢最近的卡片
+#   interval —— 距上次 fsync 超过 fsync_interval 秒时才 fsync
+#   fsync    —— 每次提交后 fsync，掉电也不丢已确认的卡片
+DURABILITY_LEVELS = ("os", "interval", "fsync")
+
+DEFAULT_PATH = os.path.join("data", "cards.jsonl")
+USERS_ROOT = os.path.join("data", "users")
+
+_USER_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+if os.name == "nt":
+    import msvcrt
+
+    # 所有进程都锁第 0 个字节；追加模式下写入位置不受 seek 影响
+    def _lock(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+    def _unlock(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+else:
+    import fcntl
+
+    def _lock(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _unlock(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def user_cards_path(user_id: str | None = None) -> str:
+    """每个用户独立的卡片文件；user_id 为空时使用默认的 data/cards.jsonl"""
+    if not user_id:
+        return DEFAULT_PATH
+    if not _USER_ID_PATTERN.match(user_id):
+        raise ValueError(f"非法的用户 id: {user_id!r}（仅允许字母、数字、_ 和 -）")
+    return os.path.join(USERS_ROOT, user_id, "cards.jsonl")
+
+
+def make_card(raw_text: str, draft: dict) -> dict:
+    """由模型输出的 draft 构造一张卡片"""
+    return {
+        "id": str(uuid.uuid4()),
+        "created_at": int(time.time() * 1000),
+        "raw_text": raw_text,
+        "summary": draft.get("summary", ""),
+        "keywords": draft.get("keywords", []),
+        "spectrum": draft.get("spectrum", {}),
+        "thinking": draft.get("thinking", ""),
+        "metaphor_domain": draft.get("metaphor_domain", ""),
+        "metaphor_seed": draft.get("metaphor_seed", 0)
+    }
+
+
+def file_identity(path: str):
+    """文件的 (设备, inode)，不存在时为 None；compact 以新文件替换后会变化，追读方据此重新开始"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+@contextmanager
+def _locked_file(path: str):
+    """
+    以追加模式打开 path 并加锁，返回文件对象
+
+    等锁期间文件可能被 compact 替换（os.replace），此时锁住的是已经脱离路径的旧文件；
+    加锁后核对一次，不一致就重新打开，保证写入落在当前的文件里。
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    while True:
+        f = open(path, "a+b")
+        _lock(f)
+        st = os.fstat(f.fileno())
+        if file_identity(path) == (st.st_dev, st.st_ino):
+            break
+        _unlock(f)
+        f.close()
+    try:
+        yield f
+    finally:
+        _unlock(f)
+        f.close()
+
+
+@contextmanager
+def file_lock(path: str):
+    """跨进程独占锁，锁文件为 path 本身（不存在时创建）"""
+    with _locked_file(path):
+        yield
+
+
+def _checksum(card: dict) -> str:
+    body = {k: v for k, v in card.items() if k != "crc"}
+    payload = json.dumps(body, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return f"{zlib.crc32(payload):08x}"
+
+
+def encode_card(card: dict) -> bytes:
+    """序列化为带校验和的一行"""
+    record = dict(card)
+    record["crc"] = _checksum(record)
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def decode_card(line: str | bytes):
+    """
+    解析一行卡片，损坏或未写完时返回 None
+
+    没有 "crc" 字段的旧记录照常接受。
+    """
+    if isinstance(line, bytes):
+        try:
+            line = line.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        card = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(card, dict):
+        return None
+    crc = card.get("crc")
+    if crc is not None and crc != _checksum(card):
+        return None
+    return card
+
+
+def iter_cards(path: str = DEFAULT_PATH):
+    """逐行读取有效卡片，跳过损坏行与末尾未写完的半行"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        for raw in f:
+            card = decode_card(raw)
+            if card is not None:
+                yield card
+
+
+def iter_cards_from(jsonl_path: str, offset: int = 0, batch_size: int = 1000):
+    """
+    从字节偏移 offset 开始逐行读取 JSONL 卡片，按批产出，内存占用与文件大小无关
+
+    只消费完整的行，末尾尚未写完的半行留给下一次读取。
+
+    Yields:
+        (cards, new_offset)，new_offset 为本批最后一行之后的偏移
+    """
+    batch = []
+    with open(jsonl_path, "rb") as f:
+        f.seek(offset)
+        line_num = 0
+        while True:
+            raw = f.readline()
+            if not raw:
+                break
+            if not raw.endswith(b"\n") and (not raw.strip() or decode_card(raw) is None):
+                # 最后一行没有换行：能完整解析（含校验和）就消费，否则视为尚未写完
+                break
+            line_num += 1
+            offset = f.tell()
+            if not raw.strip():
+                continue
+            item = decode_card(raw)
+            if item is None:
+                print(f"警告：跳过第{line_num}行（偏移 {offset - len(raw)}），JSON解析或校验失败")
+                continue
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch, offset
+                batch = []
+    yield batch, offset
+
+
+def read_cards_from(jsonl_path: str, offset: int = 0):
+    """
+    一次性读取 offset 之后的全部卡片（适合读取少量新增内容；大文件请用 iter_cards_from）
+
+    Returns:
+        (cards, new_offset)
+    """
+    cards = []
+    for batch, offset in iter_cards_from(jsonl_path, offset):
+        cards.extend(batch)
+    return cards, offset
+
+
+class CardWriter:
+    def __init__(
+        self,
+        path: str = DEFAULT_PATH,
+        durability: str | None = None,
+        group_commit: bool = True,
+        max_batch: int = 256,
+        max_delay: float = 0.01,
+        fsync_interval: float = 1.0,
+    ):
+        """
+        Args:
+            path: 卡片文件路径
+            durability: 持久化级别，见 DURABILITY_LEVELS；默认读取 .env 中的 CARD_DURABILITY，缺省为 os
+            group_commit: 是否启用后台组提交；关闭时每次 append 直接写入
+            max_batch: 单次提交最多合并的卡片数
+            max_delay: 组提交等待更多卡片的最长时间（秒）
+            fsync_interval: interval 级别下已写入的卡片最迟在这么多秒后 fsync
+        """
+        durability = durability or os.getenv("CARD_DURABILITY", "os")
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"未知的持久化级别: {durability}，可选 {DURABILITY_LEVELS}")
+        self.path = path
+        self.durability = durability
+        self.group_commit = group_commit
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.fsync_interval = fsync_interval
+        self._last_fsync = 0.0
+        # interval 级别下已写入、尚未 fsync 的数据
+        self._dirty = False
+        self._timer = None
+        self.commits = 0
+        self.records = 0
+        # 每次提交后（已释放文件锁）的回调，参数为文件路径；get_writer 用它触发按月归档
+        self.commit_listeners = []
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = None
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._closed = False
+
+    def _commit(self, lines: list[bytes]):
+        """在文件锁内一次性写入若干行"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        payload = b"".join(lines)
+        with self._write_lock, _locked_file(self.path) as f:
+            # 上一个写入者崩溃留下的半行没有换行，先补上，避免与新卡片粘连
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    payload = b"\n" + payload
+            f.write(payload)
+            f.flush()
+            now = time.monotonic()
+            if self.durability == "fsync" or (
+                self.durability == "interval"
+                and now - self._last_fsync >= self.fsync_interval
+            ):
+                os.fsync(f.fileno())
+                self._last_fsync = now
+                self._dirty = False
+            elif self.durability == "interval":
+                self._dirty = True
+        self.commits += 1
+        self.records += len(lines)
+        for listener in self.commit_listeners:
+            listener(self.path)
+        if self._dirty and not self.group_commit:
+            # 没有后台线程时用定时器补上最后一次 fsync
+            with self._start_lock:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.fsync_interval, self._flush_pending)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+    def _flush_pending(self):
+        """把 interval 级别下尚未 fsync 的写入落盘"""
+        with self._start_lock:
+            self._timer = None
+        with self._write_lock:
+            if not self._dirty:
+                return
+            with open(self.path, "ab") as f:
+                os.fsync(f.fileno())
+            self._last_fsync = time.monotonic()
+            self._dirty = False
+
+    def _next_item(self):
+        """取下一项；有未落盘的写入时最多等到 fsync 到期，超时返回 False"""
+        if not self._dirty:
+            return self._queue.get()
+        remaining = self._last_fsync + self.fsync_interval - time.monotonic()
+        try:
+            return self._queue.get(timeout=max(remaining, 0.0))
+        except queue.Empty:
+            return False
+
+    def _run(self):
+        while True:
+            item = self._next_item()
+            if item is False:
+                self._flush_pending()
+                continue
+            if item is None:
+                self._flush_pending()
+                return
+            batch = [item]
+            try:
+                while len(batch) < self.max_batch:
+                    nxt = self._queue.get(timeout=self.max_delay)
+                    if nxt is None:
+                        self._queue.put(None)
+                        break
+                    batch.append(nxt)
+            except queue.Empty:
+                pass
+            try:
+                self._commit([line for line, _ in batch])
+                error = None
+            except Exception as e:
+                error = e
+            for _, done in batch:
+                done["error"] = error
+                done["event"].set()
+
+    def append(self, card: dict, wait: bool = True):
+        """
+        追加一张卡片
+
+        Args:
+            card: 卡片字典
+            wait: 组提交模式下是否等待本批写入完成（按持久化级别确认）
+        """
+        self.append_many([card], wait=wait)
+
+    def append_many(self, cards: list[dict], wait: bool = True):
+        """追加多张卡片；非组提交模式下它们在同一次写入中落盘"""
+        if self._closed:
+            raise RuntimeError("CardWriter 已关闭")
+        lines = [encode_card(card) for card in cards]
+        if not lines:
+            return
+        if not self.group_commit:
+            self._commit(lines)
+            return
+
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="card-writer", daemon=True
+                    )
+                    self._thread.start()
+        waiters = []
+        for line in lines:
+            done = {"event": threading.Event(), "error": None}
+            self._queue.put((line, done))
+            waiters.append(done)
+        if wait:
+            for done in waiters:
+                done["event"].wait()
+                if done["error"] is not None:
+                    raise done["error"]
+
+    def close(self):
+        """写完排队中的卡片后停止后台线程"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+        if self._timer is not None:
+            self._timer.cancel()
+        self._flush_pending()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_writers: dict[str, CardWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(path: str = DEFAULT_PATH, **kwargs) -> CardWriter:
+    """
+    同一进程内按路径共享 CardWriter，使并发的 save_card 能合并提交
+
+    提交后自动把往月的卡片移入按月分片（见 scripts.card_archive），热文件只保留当月。
+    """
+    # card_archive 依赖本模块，在这里延迟导入
+    from scripts.card_archive import sync_after_commit
+
+    key = os.path.abspath(path)
+    with _writers_lock:
+        writer = _writers.get(key)
+        if writer is None:
+            writer = _writers[key] = CardWriter(path, **kwargs)
+            writer.commit_listeners.append(sync_after_commit)
+    return writer
+
+
+@atexit.register
+def _close_writers():
+    for writer in list(_writers.values()):
+        writer.close()
@@ -1,5 +1,5 @@
 ﻿# 调本地模型，产出 reply+draft 并写入库
-import os, json, time, uuid, re, ast
+import os, json, time, re, ast
 from urllib import error
 from pathlib import Path
 import sys
@@ -11,6 +11,9 @@ if _ROOT not in sys.path:
 
 from scripts.openai_client import call_chat_completion, RETRY_STATUS
 from config.model_config import get_model_config
+from scripts.card_store import get_writer, make_card, user_cards_path
+from scripts.card_dedup import screen_cards
+from scripts import tracing
 
 # 读取模型配置
 cfg = get_model_config()
@@ -110,23 +113,13 @@ def aphasia_guard(text: str) -> str:
     return text
 
 
-def save_card(raw_text: str, draft: dict):
-    os.makedirs("data", exist_ok=True)
-    path = os.path.join("data", "cards.jsonl")
-    card = {
-        "id": str(uuid.uuid4()),
-        "created_at": int(time.time() * 1000),
-        "raw_text": raw_text,
-        "summary": draft.get("summary", ""),
-        "keywords": draft.get("keywords", []),
-        "spectrum": draft.get("spectrum", {}),
-        "thinking": draft.get("thinking", ""),
-        "metaphor_domain": draft.get("metaphor_domain", ""),
-        "metaphor_seed": draft.get("metaphor_seed", 0)
-    }
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(json.dumps(card, ensure_ascii=False) + "\n")
-    print("记忆已封存到 data/cards.jsonl\n")
+def save_card(raw_text: str, draft: dict, user_id: str | None = None):
+    path = user_cards_path(user_id)
+    card = make_card(raw_text, draft)
+    if screen_cards(path, [card]):
+        get_writer(path).append(card)
+        print(f"记忆已封存到 {path}\n")
+    return card
 
 
 def main():
@@ -152,6 +145,7 @@ def main():
             last_err = e
             if attempt == 4:
                 raise
+        tracing.incr("llm_retries_total", model=MODEL)
         time.sleep(delay)
         delay *= 2
     if resp is None:
@@ -159,10 +153,12 @@ def main():
 
     content = resp["choices"][0]["message"]["content"]
 
-    data = parse_model_output(content)
+    with tracing.span("card.parse"):
+        data = parse_model_output(content)
     draft = data.get("draft", {}) if isinstance(data, dict) else {}
     reply_raw = data.get("reply") or draft.get("reply", "")
-    reply = aphasia_guard(reply_raw)
+    with tracing.span("card.guard"):
+        reply = aphasia_guard(reply_raw)
 
     print("\n——馆员的回复——")
     print(reply)
@@ -0,0 +1,336 @@
+"""
+多模型并行评测：同一批输入同时发给 .env 中配置的多个模型，一次跑完全部对比。
+
+- 每个目标一个线程池，并发上限取 {TARGET}_MAX_CONCURRENCY 或 --concurrency，
+  由信号量在调用内限制，排队时间计入 llm_queue_seconds
+- card 任务：system_librarian 提示词 + emotion_schema，统计 parse_model_output 失败率、
+  draft.thinking（思维链）填写率与 aphasia_guard 命中
+- rag 任务：每个问题只检索、打包一次上下文，再把相同的消息发给各模型
+- 每次调用写入 results.jsonl，汇总为并排对比表（Markdown）
+
+用法（在项目根目录）：
+python scripts/eval_models.py --targets LOCAL,OPENROUTER --inputs raw.csv --limit 50
+python scripts/eval_models.py --task rag --inputs questions.txt --concurrency OPENROUTER=8
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib import error
+
+_ROOT = str(Path(__file__).resolve().parents[1])
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+from config.model_config import get_model_config, list_model_targets  # noqa: E402
+from scripts.openai_client import call_chat_completion, RETRY_STATUS  # noqa: E402
+
+TASKS = ("card", "rag")
+
+
+def _quantile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class _Slots:
+    """并发名额：包装 threading.Semaphore，记下本线程取得名额的时刻，使延迟统计不含排队"""
+
+    def __init__(self, n: int):
+        self._sem = threading.Semaphore(n)
+        self._local = threading.local()
+
+    def acquire(self):
+        self._sem.acquire()
+        self._local.acquired_at = time.perf_counter()
+
+    def release(self):
+        self._sem.release()
+
+    def acquired_at(self, default: float) -> float:
+        return getattr(self._local, "acquired_at", default)
+
+
+def _call(cfg, messages, temperature, max_tokens, retries=3, limiter=None):
+    """带重试的单次调用，返回 (content, usage, 耗时秒, 重试次数)；limiter 为 _Slots"""
+    delay = 1.0
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            resp = call_chat_completion(
+                cfg["base_url"],
+                cfg["api_key"],
+                cfg["name"],
+                messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                timeout=300,
+                limiter=limiter,
+            )
+            if limiter is not None:
+                start = limiter.acquired_at(start)
+            elapsed = time.perf_counter() - start
+            return resp["choices"][0]["message"]["content"], resp.get("usage") or {}, elapsed, attempt
+        except error.HTTPError as e:
+            if e.code not in RETRY_STATUS or attempt == retries:
+                raise
+        except error.URLError:
+            if attempt == retries:
+                raise
+        time.sleep(delay)
+        delay *= 2
+
+
+def build_card_jobs(texts):
+    """card 任务：与 scripts/input.py 的 full 模式相同的消息"""
+    from scripts.input import SYSTEM_PROMPT, EMO
+
+    schema = json.dumps(EMO, ensure_ascii=False)
+    return [
+        {
+            "input": text,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": f"user_input: {text}\nemotion_schema: {schema}"},
+            ],
+        }
+        for text in texts
+    ]
+
+
+def build_rag_jobs(questions, jsonl_path, top_k=3, context_budget=1500):
+    """rag 任务：检索与上下文打包只做一次，各模型收到完全相同的消息"""
+    from rag.RAG_LM import EmotionRAG
+
+    rag = EmotionRAG(jsonl_path=jsonl_path, context_budget=context_budget)
+    jobs = []
+    for question in questions:
+        results = rag.search(question, top_k=top_k)
+        entries, _ = rag.build_context(results)
+        jobs.append({"input": question, "messages": rag.build_messages(question, entries)})
+    return jobs
+
+
+def score(task, content):
+    """按任务检查一次回复：解析是否成功、是否给出思维链、审查命中数"""
+    from scripts.input import aphasia_guard, parse_model_output
+
+    record = {"parse_ok": None, "cot": None}
+    text = content
+    if task == "card":
+        try:
+            data = parse_model_output(content)
+            draft = data.get("draft", {}) if isinstance(data, dict) else {}
+            text = data.get("reply") or draft.get("reply", "")
+            record["parse_ok"] = True
+            record["cot"] = bool(str(draft.get("thinking", "")).strip())
+        except ValueError:
+            record["parse_ok"] = False
+            record["cot"] = False
+    guarded = aphasia_guard(text)
+    record["guard_hits"] = guarded.count("*") - text.count("*")
+    return record
+
+
+def run_target(cfg, jobs, task, concurrency, temperature, max_tokens, sink):
+    """把全部输入发给一个目标，结果逐条交给 sink"""
+    limiter = _Slots(concurrency)
+
+    def one(index, job):
+        row = {"target": cfg["target"], "model": cfg["name"], "index": index, "input": job["input"]}
+        try:
+            content, usage, elapsed, retries = _call(cfg, job["messages"], temperature, max_tokens, limiter=limiter)
+            row.update(
+                ok=True,
+                latency=elapsed,
+                retries=retries,
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                completion_tokens=usage.get("completion_tokens", 0),
+                output=content,
+            )
+            row.update(score(task, content))
+        except Exception as e:
+            row.update(ok=False, error=str(e))
+        sink(row)
+
+    # 线程数多于并发上限，排队发生在 limiter 上而不是线程池的任务队列里
+    workers = max(1, min(len(jobs), concurrency * 4))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"eval-{cfg['target']}") as pool:
+        for index, job in enumerate(jobs):
+            pool.submit(one, index, job)
+
+
+def summarize(rows, wall_seconds):
+    """按目标汇总为表格行"""
+    by_target = {}
+    for row in rows:
+        by_target.setdefault(row["target"], []).append(row)
+    table = []
+    for target, items in sorted(by_target.items()):
+        ok = [r for r in items if r["ok"]]
+        parsed = [r for r in ok if r.get("parse_ok") is not None]
+        latencies = [r["latency"] for r in ok]
+        table.append(
+            {
+                "target": target,
+                "model": items[0]["model"],
+                "calls": len(items),
+                "errors": len(items) - len(ok),
+                "parse_fail_rate": (
+                    sum(1 for r in parsed if not r["parse_ok"]) / len(parsed) if parsed else None
+                ),
+                "cot_rate": sum(1 for r in parsed if r["cot"]) / len(parsed) if parsed else None,
+                "guard_hits": sum(r["guard_hits"] for r in ok),
+                "guarded_replies": sum(1 for r in ok if r["guard_hits"]),
+                "latency_p50": _quantile(latencies, 0.5),
+                "latency_p90": _quantile(latencies, 0.9),
+                "prompt_tokens": sum(r["prompt_tokens"] for r in ok),
+                "completion_tokens": sum(r["completion_tokens"] for r in ok),
+                "retries": sum(r["retries"] for r in ok),
+                "wall_seconds": wall_seconds.get(target, 0.0),
+            }
+        )
+    return table
+
+
+def render_table(table) -> str:
+    """并排对比表（Markdown）"""
+
+    def pct(value):
+        return "-" if value is None else f"{value:.1%}"
+
+    header = (
+        "| 目标 | 模型 | 调用 | 失败 | 解析失败率 | 思维链 | 审查命中 | 被审查回复 "
+        "| 延迟 p50 | 延迟 p90 | 输入 tokens | 输出 tokens | 重试 | 耗时 |"
+    )
+    lines = [header, "|" + "---|" * (header.count("|") - 1)]
+    for t in table:
+        lines.append(
+            f"| {t['target']} | {t['model']} | {t['calls']} | {t['errors']} "
+            f"| {pct(t['parse_fail_rate'])} | {pct(t['cot_rate'])} | {t['guard_hits']} | {t['guarded_replies']} "
+            f"| {t['latency_p50']:.2f}s | {t['latency_p90']:.2f}s "
+            f"| {t['prompt_tokens']} | {t['completion_tokens']} | {t['retries']} | {t['wall_seconds']:.1f}s |"
+        )
+    return "\n".join(lines)
+
+
+def parse_concurrency(value: str) -> dict:
+    """解析一个 --concurrency 值（如 "LOCAL=1,OPENROUTER=8"）；格式不对时由 argparse 报出用法错误"""
+    limits = {}
+    for part in value.split(","):
+        if not part.strip():
+            continue
+        target, sep, n = part.partition("=")
+        try:
+            number = int(n)
+        except ValueError:
+            number = 0
+        if not sep or not target.strip() or number < 1:
+            raise argparse.ArgumentTypeError(f"应为 目标=正整数（如 LOCAL=1）: {part.strip()!r}")
+        limits[target.strip().upper()] = number
+    return limits
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="多模型并行评测")
+    parser.add_argument("--targets", default=None, help="逗号分隔的目标名，默认 .env 中全部已配置目标")
+    parser.add_argument("--task", choices=TASKS, default="card", help="评测任务")
+    parser.add_argument("--inputs", default="raw.csv", help="输入文件（每行一条；rag 任务为问题）")
+    parser.add_argument("--limit", type=int, default=None, help="只取前 N 条输入")
+    parser.add_argument(
+        "--concurrency",
+        type=parse_concurrency,
+        action="append",
+        default=[],
+        help="按目标覆盖并发上限，如 LOCAL=1,OPENROUTER=8，可重复",
+    )
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--max-tokens", type=int, default=None)
+    parser.add_argument("--jsonl", default="data/cards.jsonl", help="rag 任务检索的卡片库")
+    parser.add_argument("--top-k", type=int, default=3, help="rag 任务的检索条数")
+    parser.add_argument("--out-dir", default="eval_results", help="结果目录")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.chdir(_ROOT)
+
+    targets = [t.strip().upper() for t in args.targets.split(",")] if args.targets else list_model_targets()
+    if not targets:
+        print("错误: .env 中没有配置任何模型目标（*_MODEL_NAME / *_API_BASE）")
+        return
+    limits = {}
+    for item in args.concurrency:
+        limits.update(item)
+    configs = []
+    for target in targets:
+        cfg = get_model_config(target)
+        if not cfg["name"] or not cfg["base_url"]:
+            print(f"跳过 {target}: 缺少 {target}_MODEL_NAME 或 {target}_API_BASE")
+            continue
+        cfg["max_concurrency"] = limits.get(target, cfg["max_concurrency"])
+        configs.append(cfg)
+
+    from scripts.input import iter_csv_rows
+
+    texts = list(itertools.islice(iter_csv_rows(args.inputs), args.limit))
+    if args.task == "card":
+        jobs = build_card_jobs(texts)
+    else:
+        jobs = build_rag_jobs(texts, args.jsonl, top_k=args.top_k)
+    print(f"评测任务 {args.task}：{len(jobs)} 条输入 × {len(configs)} 个模型")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    rows = []
+    lock = threading.Lock()
+    results_path = os.path.join(args.out_dir, "results.jsonl")
+    out = open(results_path, "w", encoding="utf-8")
+
+    def sink(row):
+        with lock:
+            rows.append(row)
+            out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            done = sum(1 for r in rows if r["target"] == row["target"])
+            mark = "✓" if row["ok"] else "✗"
+            print(f"{mark} [{row['target']}] {done}/{len(jobs)}")
+
+    wall_seconds = {}
+
+    def run(cfg):
+        start = time.perf_counter()
+        run_target(cfg, jobs, args.task, cfg["max_concurrency"], args.temperature, args.max_tokens, sink)
+        wall_seconds[cfg["target"]] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(cfg,)) for cfg in configs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    out.close()
+    total = time.perf_counter() - start
+
+    table = summarize(rows, wall_seconds)
+    markdown = render_table(table)
+    with open(os.path.join(args.out_dir, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump({"task": args.task, "inputs": len(jobs), "wall_seconds": total, "targets": table}, f, ensure_ascii=False, indent=2)
+    with open(os.path.join(args.out_dir, "summary.md"), "w", encoding="utf-8") as f:
+        f.write(markdown + "\n")
+
+    print("\n" + markdown)
+    print(f"\n总耗时 {total:.1f}s，结果已写入 {args.out_dir}/")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 # 批量阅读.csv文件并产出 reply+draft 写入库
 
-import os, json, time, uuid, re, ast
+import os, json, time, re, ast, argparse, codecs, csv, itertools
 from urllib import error
 from pathlib import Path
 import sys
@@ -12,6 +12,9 @@ if _ROOT not in sys.path:
 
 from scripts.openai_client import call_chat_completion, RETRY_STATUS
 from config.model_config import get_model_config
+from scripts.card_store import get_writer, make_card, user_cards_path
+from scripts.card_dedup import screen_cards
+from scripts import tracing
 
 # 读取模型配置
 cfg = get_model_config()
@@ -111,46 +114,36 @@ def aphasia_guard(text: str) -> str:
     return text
 
 
-def save_card(raw_text: str, draft: dict, verbose: bool = True):
-    os.makedirs("data", exist_ok=True)
-    path = os.path.join("data", "cards.jsonl")
-    card = {
-        "id": str(uuid.uuid4()),
-        "created_at": int(time.time() * 1000),
-        "raw_text": raw_text,
-        "summary": draft.get("summary", ""),
-        "keywords": draft.get("keywords", []),
-        "spectrum": draft.get("spectrum", {}),
-        "thinking": draft.get("thinking", ""),
-        "metaphor_domain": draft.get("metaphor_domain", ""),
-        "metaphor_seed": draft.get("metaphor_seed", 0)
-    }
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(json.dumps(card, ensure_ascii=False) + "\n")
-    if verbose:
-        print("记忆已封存到 data/cards.jsonl\n")
-
-
-def process_single_text(user_input: str, verbose: bool = True):
-    """处理单条文本并保存"""
-    if not user_input or not user_input.strip():
+def save_card(raw_text: str, draft: dict, verbose: bool = True, user_id: str | None = None):
+    path = user_cards_path(user_id)
+    card = make_card(raw_text, draft)
+    if screen_cards(path, [card]):
+        get_writer(path).append(card)
         if verbose:
-            print("跳过空文本")
-        return False
-    
-    user_input = user_input.strip()
-    
-    msg = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": f"user_input: {user_input}\nemotion_schema: {json.dumps(EMO, ensure_ascii=False)}"}
-    ]
+            print(f"记忆已封存到 {path}\n")
+    return card
 
+
+REPLY_PROMPT = (
+    "你是失忆的图书馆员「伞」。根据用户的记忆片段和已经标注好的情感光谱与隐喻域，"
+    "写一句简短、含蓄、诗意的隐喻化回复。绝对禁止出现直接的情绪词，只输出回复本身。"
+)
+
+# 生成模式：
+#   full  —— 由 LLM 生成完整 draft 与 reply（原流程）
+#   reply —— 本地预分类填写 spectrum / metaphor_domain，LLM 只写 reply
+#   local —— 完全不调用 LLM，只做本地预分类后归档（适合批量导入旧日记）
+MODES = ("full", "reply", "local")
+
+
+def request_completion(msg, temperature=0.7, max_tokens=None, limiter=None):
+    """带指数退避重试的 LLM 调用，返回回复文本；limiter 为调用方共享的并发限制（见 call_chat_completion）"""
     delay = 1.0
     last_err = None
     resp = None
     for attempt in range(5):
         try:
-            resp = call_chat_completion(BASE, KEY, MODEL, msg, temperature=0.7, timeout=300)
+            resp = call_chat_completion(BASE, KEY, MODEL, msg, temperature=temperature, max_tokens=max_tokens, timeout=300, limiter=limiter)
             break
         except error.HTTPError as e:
             last_err = e
@@ -160,71 +153,245 @@ def process_single_text(user_input: str, verbose: bool = True):
             last_err = e
             if attempt == 4:
                 raise
+        tracing.incr("llm_retries_total", model=MODEL)
         time.sleep(delay)
         delay *= 2
     if resp is None:
         raise last_err
 
-    content = resp["choices"][0]["message"]["content"]
+    return resp["choices"][0]["message"]["content"]
+
 
-    data = parse_model_output(content)
-    draft = data.get("draft", {}) if isinstance(data, dict) else {}
-    reply_raw = data.get("reply") or draft.get("reply", "")
-    reply = aphasia_guard(reply_raw)
+def generate_draft(user_input: str, mode: str = "full", classifier=None, limiter=None):
+    """
+    为一条文本生成 draft 与（已过审查的）回复，不写入文件
+
+    mode 为 reply / local 时需要传入 ToneClassifier；local 模式的回复为空字符串。
+    limiter（threading.Semaphore）只限制 LLM 调用本身，本地预分类不占名额。
+    """
+    if mode == "full":
+        msg = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"user_input: {user_input}\nemotion_schema: {json.dumps(EMO, ensure_ascii=False)}"}
+        ]
+        content = request_completion(msg, temperature=0.7, limiter=limiter)
+
+        with tracing.span("card.parse"):
+            data = parse_model_output(content)
+        draft = data.get("draft", {}) if isinstance(data, dict) else {}
+        reply_raw = data.get("reply") or draft.get("reply", "")
+    else:
+        with tracing.span("card.classify"):
+            draft = classifier.classify(user_input)
+        reply_raw = ""
+        if mode == "reply":
+            spectrum = draft["spectrum"]
+            msg = [
+                {"role": "system", "content": REPLY_PROMPT},
+                {"role": "user", "content": (
+                    f"记忆片段：{user_input}\n"
+                    f"效价：{spectrum['valence']}，唤醒度：{spectrum['arousal']}，色调：{'、'.join(spectrum['tones'])}\n"
+                    f"隐喻域：{draft['metaphor_domain']}（可用意象：{'、'.join(draft['keywords'])}）"
+                )},
+            ]
+            reply_raw = request_completion(msg, temperature=0.7, max_tokens=200, limiter=limiter).strip()
+
+    with tracing.span("card.guard"):
+        reply = aphasia_guard(reply_raw)
+    return draft, reply
+
+
+def process_single_text(user_input: str, verbose: bool = True, user_id: str | None = None,
+                        mode: str = "full", classifier=None):
+    """处理单条文本并保存；mode 为 reply / local 时需要传入 ToneClassifier"""
+    if not user_input or not user_input.strip():
+        if verbose:
+            print("跳过空文本")
+        return False
+    
+    user_input = user_input.strip()
+    draft, reply = generate_draft(user_input, mode=mode, classifier=classifier)
 
-    if verbose:
+    if verbose and reply:
         print("\n——馆员的回复——")
         print(reply)
 
-    save_card(user_input, draft, verbose=verbose)
+    save_card(user_input, draft, verbose=verbose, user_id=user_id)
     return True
 
 
-def read_csv_file(filepath: str):
-    """尝试多种编码读取CSV文件"""
-    encodings = ['utf-8', 'gbk', 'gb2312', 'utf-8-sig']
-    for enc in encodings:
+def import_local(texts, classifier, batch_size: int = 64, user_id: str | None = None):
+    """local 模式的批量导入：按批本地分类，并在一次写入中归档整批卡片；texts 可以是惰性迭代器"""
+    path = user_cards_path(user_id)
+    writer = get_writer(path)
+    total = 0
+    texts = iter(texts)
+    while True:
+        chunk = list(itertools.islice(texts, batch_size))
+        if not chunk:
+            break
+        # 整批都是空白时跳过这一批，而不是当作输入结束
+        batch = [t.strip() for t in chunk if t.strip()]
+        if not batch:
+            continue
+        with tracing.span("card.classify"):
+            drafts = classifier.classify_batch(batch)
+        cards = [make_card(text, draft) for text, draft in zip(batch, drafts)]
+        writer.append_many(screen_cards(path, cards))
+        total += len(batch)
+        print(f"已归档 {total}")
+    return total
+
+
+# 编码嗅探只读文件开头这么多字节；gb18030 覆盖 gbk / gb2312
+SNIFF_BYTES = 64 * 1024
+ENCODINGS = ("utf-8", "gb18030")
+
+# 长日记可能超过 csv 默认的单字段 128KB 上限
+csv.field_size_limit(max(csv.field_size_limit(), 1 << 24))
+
+
+def sniff_encoding(filepath: str, prefix_bytes: int = SNIFF_BYTES) -> str:
+    """
+    根据文件内容判断编码（BOM 优先），不读取整个文件
+
+    纯 ASCII 的字节对 utf-8 与 gb18030 都合法、无法区分：开头若全是 ASCII（如很长的英文表头），
+    就继续往后找第一个非 ASCII 字节，再以它起始的 prefix_bytes 字节判断。
+    """
+    with open(filepath, "rb") as f:
+        sample = f.read(prefix_bytes)
+        if sample.startswith(codecs.BOM_UTF8):
+            return "utf-8-sig"
+        while sample.isascii():
+            sample = f.read(prefix_bytes)
+            if not sample:
+                # 全文都是 ASCII
+                return "utf-8"
+        # 前一个字节是 ASCII，因此这里一定是字符边界
+        start = next(i for i, b in enumerate(sample) if b >= 0x80)
+        window = sample[start:]
+        if len(window) < prefix_bytes:
+            window += f.read(prefix_bytes - len(window))
+    for enc in ENCODINGS:
+        # 增量解码且 final=False：窗口末尾被截断的多字节字符不算失败
+        decoder = codecs.getincrementaldecoder(enc)()
         try:
-            with open(filepath, "r", encoding=enc) as f:
-                lines = [line.strip() for line in f if line.strip()]
-                return lines
+            decoder.decode(window, final=False)
+            return enc
         except UnicodeDecodeError:
             continue
-        except Exception as e:
-            print(f"读取文件时出错 (编码: {enc}): {e}")
-            continue
     raise ValueError(f"无法使用常见编码读取文件: {filepath}")
 
 
+def iter_csv_rows(filepath: str, column: str | int | None = None, encoding: str | None = None,
+                  delimiter: str = ",", header: bool = False, errors: str = "replace"):
+    """
+    逐条产出 CSV 记录中的文本，内存占用与文件大小无关
+
+    Args:
+        filepath: CSV 文件路径
+        column: 取哪一列。None 表示整条记录（各字段按分隔符拼回，兼容单列的 raw.csv）；
+                整数为列序号；字符串为表头中的列名（此时首行视为表头）
+        encoding: 文件编码，None 时自动嗅探
+        delimiter: 分隔符
+        header: 首行是否为表头（按列名取列时总是视为表头）
+        errors: 解码错误的处理方式。嗅探只看一段样本，后面仍可能出现无法解码的字节；
+                默认跳过含有这类字节的记录并打印所在行号（不会产出乱码），
+                "strict" 则直接抛出 UnicodeDecodeError
+    """
+    encoding = encoding or sniff_encoding(filepath)
+    # newline="" 让 csv 模块自己处理引号内的换行，多行条目不会被拆开
+    with open(filepath, "r", encoding=encoding, errors=errors, newline="") as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        index = column
+        if isinstance(column, str):
+            names = [name.strip() for name in next(reader, None) or []]
+            if column not in names:
+                raise ValueError(f"CSV 表头中没有列 {column!r}: {names}")
+            index = names.index(column)
+        elif header:
+            next(reader, None)
+        for row in reader:
+            if index is None:
+                text = delimiter.join(row)
+            elif index < len(row):
+                text = row[index]
+            else:
+                continue
+            text = text.strip()
+            if errors == "replace" and "\ufffd" in text:
+                print(f"警告：跳过第{reader.line_num}行，含无法按 {encoding} 解码的字节")
+                continue
+            if text:
+                yield text
+
+
+def read_csv_file(filepath: str, column: str | int | None = None):
+    """读取整个 CSV 为文本列表（小文件用；大文件请直接迭代 iter_csv_rows）"""
+    return list(iter_csv_rows(filepath, column=column))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="批量读取 CSV 并生成记忆卡片")
+    parser.add_argument("--csv", default="raw.csv", help="CSV 文件路径")
+    parser.add_argument(
+        "--column", default=None, help="文本所在的列：列名（首行为表头）或从 0 开始的序号，默认整行"
+    )
+    parser.add_argument("--encoding", default=None, help="文件编码，默认根据文件开头自动判断")
+    parser.add_argument("--header", action="store_true", help="首行为表头（--column 为列名时自动视为表头）")
+    parser.add_argument("--mode", choices=MODES, default="full", help="生成模式：full / reply / local")
+    parser.add_argument("--user", default=None, help="写入该用户的图书馆")
+    parser.add_argument("--batch-size", type=int, default=64, help="local 模式的分类批大小")
+    parser.add_argument("--embedding-model", default="moka-ai/m3e-base", help="本地预分类使用的向量模型")
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     # 批量处理 raw.csv 中的文本
-    csv_path = os.path.join("raw.csv")
+    csv_path = args.csv
     
     if not os.path.exists(csv_path):
         print(f"错误: 找不到文件 {csv_path}")
         return
     
+    column = args.column
+    if column is not None and column.isdigit():
+        column = int(column)
     print(f"开始读取文件: {csv_path}")
     try:
-        texts = read_csv_file(csv_path)
-        print(f"成功读取 {len(texts)} 条文本\n")
+        encoding = args.encoding or sniff_encoding(csv_path)
+        print(f"文件编码: {encoding}\n")
     except Exception as e:
         print(f"读取文件失败: {e}")
         return
+    # 惰性读取：边读边处理，不把整个文件载入内存
+    texts = iter_csv_rows(csv_path, column=column, encoding=encoding, header=args.header)
+
+    classifier = None
+    if args.mode != "full":
+        from scripts.tone_classifier import ToneClassifier
+
+        classifier = ToneClassifier(embedding_model=args.embedding_model)
+        classifier.fit_from_cards(user_cards_path(args.user))
+        if args.mode == "local":
+            import_local(texts, classifier, batch_size=args.batch_size, user_id=args.user)
+            return
     
-    total = len(texts)
+    total = 0
     success_count = 0
     fail_count = 0
     
     for idx, text in enumerate(texts, 1):
-        print(f"\n[{idx}/{total}] 处理文本: {text[:50]}...")
+        total = idx
+        print(f"\n[{idx}] 处理文本: {text[:50]}...")
         try:
-            process_single_text(text, verbose=False)
+            process_single_text(text, verbose=False, user_id=args.user, mode=args.mode, classifier=classifier)
             success_count += 1
-            print(f"✓ 成功处理 ({success_count}/{total})")
+            print(f"✓ 成功处理 ({success_count}/{idx})")
         except Exception as e:
             fail_count += 1
-            print(f"✗ 处理失败: {e} ({fail_count}/{total})")
+            print(f"✗ 处理失败: {e} ({fail_count}/{idx})")
             # 继续处理下一条
             continue
     
@@ -1,13 +1,19 @@
 ﻿import json
+import time
 import requests
 from urllib import error
 
+from scripts import tracing
+
 RETRY_STATUS = {429, 500, 502, 503, 504}
 
-def call_chat_completion(base_url, api_key, model, messages, *, temperature=0.7, max_tokens=None, timeout=120):
+def call_chat_completion(base_url, api_key, model, messages, *, temperature=0.7, max_tokens=None, timeout=120, limiter=None):
     """
     通用 OpenAI-Compatible Chat API 调用函数。
     支持本地 LM Studio / OpenAI / DeepSeek / Claude 等。
+
+    limiter: 可选的并发限制（threading.Semaphore），等待时间记为排队耗时。
+    每次调用记录排队、首字节（TTFB）、总耗时与 prompt/completion token 数。
     """
 
     payload = {
@@ -26,13 +32,96 @@ def call_chat_completion(base_url, api_key, model, messages, *, temperature=0.7,
     if api_key:
         headers["Authorization"] = f"Bearer {api_key}"
 
+    queued_at = time.perf_counter()
+    if limiter is not None:
+        limiter.acquire()
     try:
-        resp = requests.post(endpoint, json=payload, headers=headers, timeout=timeout)
-        resp.raise_for_status()
-        return resp.json()
+        start = time.perf_counter()
+        tracing.observe("llm_queue_seconds", start - queued_at, model=model)
+        with tracing.span("llm.chat_completion", model=model):
+            # stream=True 时 post 在收到响应头后返回，用来测 TTFB
+            resp = requests.post(endpoint, json=payload, headers=headers, timeout=timeout, stream=True)
+            tracing.observe("llm_ttfb_seconds", time.perf_counter() - start, model=model)
+            resp.raise_for_status()
+            data = resp.json()
+        tracing.observe("llm_total_seconds", time.perf_counter() - start, model=model)
+        usage = data.get("usage") or {}
+        tracing.incr("llm_prompt_tokens_total", usage.get("prompt_tokens", 0), model=model)
+        tracing.incr("llm_completion_tokens_total", usage.get("completion_tokens", 0), model=model)
+        return data
     except requests.exceptions.RequestException as e:
         # 与原 urllib 兼容：抛出 error.URLError 或 error.HTTPError
         if hasattr(e, "response") and e.response is not None:
+            tracing.incr("llm_errors_total", model=model, status=e.response.status_code)
+            raise error.HTTPError(endpoint, e.response.status_code, str(e), headers, None)
+        else:
+            tracing.incr("llm_errors_total", model=model, status="network")
+            raise error.URLError(str(e))
+    finally:
+        if limiter is not None:
+            limiter.release()
+
+
+def stream_chat_completion(base_url, api_key, model, messages, *, temperature=0.7, max_tokens=None, timeout=120):
+    """
+    流式版本：逐段产出回复文本（SSE 的 choices[0].delta.content）。
+    异常与 call_chat_completion 一致，转换为 error.HTTPError / error.URLError。
+    """
+
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "stream": True,
+    }
+    if max_tokens is not None:
+        payload["max_tokens"] = max_tokens
+
+    endpoint = f"{base_url.rstrip('/')}/chat/completions"
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream",
+    }
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+
+    # 生成器会在不同的上下文里被逐次 next()（如 Starlette 的线程池），不能跨 yield 持有 span，
+    # 这里手动计时，结果与 span 一样记入 amnesia_span_seconds
+    name = "llm.chat_completion_stream"
+    path = "/".join(filter(None, (tracing.current_span(), name)))
+    start = time.perf_counter()
+    first = True
+    try:
+        resp = requests.post(endpoint, json=payload, headers=headers, timeout=timeout, stream=True)
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            # SSE 多不带 charset，requests 会按 ISO-8859-1 解码，这里按 UTF-8 自行解码
+            line = line.decode("utf-8")
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            usage = chunk.get("usage") or {}
+            if usage:
+                tracing.incr("llm_prompt_tokens_total", usage.get("prompt_tokens", 0), model=model)
+                tracing.incr("llm_completion_tokens_total", usage.get("completion_tokens", 0), model=model)
+            for choice in chunk.get("choices") or []:
+                text = (choice.get("delta") or {}).get("content")
+                if text:
+                    if first:
+                        # 流式时以首个 token 到达为 TTFB
+                        tracing.observe("llm_ttfb_seconds", time.perf_counter() - start, model=model)
+                        first = False
+                    yield text
+        elapsed = time.perf_counter() - start
+        tracing.observe("llm_total_seconds", elapsed, model=model)
+        tracing.observe("amnesia_span_seconds", elapsed, span=name, path=path, model=model)
+    except requests.exceptions.RequestException as e:
+        if hasattr(e, "response") and e.response is not None:
+            tracing.incr("llm_errors_total", model=model, status=e.response.status_code)
             raise error.HTTPError(endpoint, e.response.status_code, str(e), headers, None)
         else:
+            tracing.incr("llm_errors_total", model=model, status="network")
             raise error.URLError(str(e))
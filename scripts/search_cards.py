@@ -1,10 +1,15 @@
-import json, os, sys
+import os, sys
+from pathlib import Path
+
+_ROOT = str(Path(__file__).resolve().parents[1])
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+from scripts.card_store import iter_cards
 
 def load_cards():
     path = os.path.join("data","cards.jsonl")
-    if not os.path.exists(path): return []
-    with open(path,"r",encoding="utf-8") as f:
-        return [json.loads(line) for line in f if line.strip()]
+    return list(iter_cards(path))
 
 def search(keyword=None, tone=None):
     cards = load_cards()
@@ -0,0 +1,236 @@
+"""
+本地情绪预分类：不调用 LLM，直接给出 spectrum.tones / valence / arousal / metaphor_domain。
+
+- emotion_schema.json 中的色调词与隐喻意象只向量化一次，缓存到 data/.cache/
+- 色调：与文本向量最相近的若干色调词
+- 效价 / 唤醒度：在已有 cards.jsonl 上训练的岭回归（卡片太少时退化为近邻加权平均，
+  再退化为所选色调所在象限的先验值）
+- 隐喻域：按效价 / 唤醒度象限查 domains_map，意象取该域中最相近的几个
+
+用法：
+    clf = ToneClassifier()
+    clf.fit_from_cards("data/cards.jsonl")
+    draft = clf.classify("下雨天的出租车上，突然想起你")
+"""
+
+from __future__ import annotations
+
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+from pathlib import Path
+
+import numpy as np
+
+_ROOT = str(Path(__file__).resolve().parents[1])
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+from scripts.card_archive import iter_archived  # noqa: E402
+from scripts.card_store import iter_cards  # noqa: E402
+
+CACHE_DIR = os.path.join("data", ".cache")
+
+# 各象限的效价 / 唤醒度先验
+QUADRANT_PRIORS = {
+    "neg_low": (-0.5, 0.25),
+    "neg_high": (-0.5, 0.75),
+    "pos_low": (0.5, 0.25),
+    "pos_high": (0.5, 0.75),
+}
+
+
+def _load_schema(path: str | None = None) -> dict:
+    path = path or os.path.join(_ROOT, "emotion_schema.json")
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _normalize(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class ToneClassifier:
+    def __init__(
+        self,
+        embedder=None,
+        embedding_model: str = "moka-ai/m3e-base",
+        schema_path: str | None = None,
+        cache_dir: str = CACHE_DIR,
+        top_tones: int = 3,
+    ):
+        """
+        Args:
+            embedder: 共享的向量模型（需提供 encode），为空时按 embedding_model 加载
+            embedding_model: 向量模型名称，同时用作缓存键
+            schema_path: emotion_schema.json 路径
+            cache_dir: 词表与卡片向量缓存目录
+            top_tones: 每张卡片选取的色调数
+        """
+        if embedder is None:
+            from sentence_transformers import SentenceTransformer
+
+            print("加载向量模型...")
+            embedder = SentenceTransformer(embedding_model)
+        self.embedder = embedder
+        self.model_name = embedding_model
+        self.cache_dir = cache_dir
+        self.top_tones = top_tones
+
+        schema = _load_schema(schema_path)
+        self.domains_map = schema["domains_map"]
+        self.domain_images = schema["domains"]
+        # 色调词 -> 所在象限（来自 tones_quadrants；tones_groups 中的词没有象限）
+        self.tone_quadrant = {}
+        for quadrant, tones in schema["tones_quadrants"].items():
+            for tone in tones:
+                self.tone_quadrant.setdefault(tone, quadrant)
+        tones = list(self.tone_quadrant)
+        for group in schema["tones_groups"].values():
+            tones.extend(t for t in group if t not in self.tone_quadrant)
+        self.tones = list(dict.fromkeys(tones))
+
+        self.tone_vectors = self._cached_vocab("tones", self.tones)
+        self.image_vectors = {
+            domain: self._cached_vocab(f"domain_{domain}", images)
+            for domain, images in self.domain_images.items()
+        }
+
+        self.card_vectors = None
+        self.card_targets = None
+        self.head = None
+
+    # ---------- 向量与缓存 ----------
+
+    def _encode(self, texts: list[str]):
+        return _normalize(self.embedder.encode(texts))
+
+    def _cache_path(self, name: str, key: str) -> str:
+        model = self.model_name.replace("/", "_")
+        return os.path.join(self.cache_dir, f"{name}_{model}_{key}.npy")
+
+    def _cached_vocab(self, name: str, words: list[str]):
+        key = hashlib.sha1("\n".join(words).encode("utf-8")).hexdigest()[:12]
+        path = self._cache_path(name, key)
+        if os.path.exists(path):
+            return np.load(path)
+        vectors = self._encode(words)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        np.save(path, vectors)
+        return vectors
+
+    # ---------- 训练 ----------
+
+    def fit_from_cards(self, jsonl_path: str, ridge: float = 1.0, min_cards: int = 20):
+        """
+        用已有卡片训练效价 / 唤醒度回归头
+
+        包括已移入按月分片的往月卡片。卡片原文向量按 id 缓存在磁盘上（每个卡片文件一份），
+        重复训练只向量化新增卡片。
+        """
+        samples = []
+        archived = (card for cards in iter_archived(jsonl_path) for card in cards)
+        for card in itertools.chain(archived, iter_cards(jsonl_path)):
+            spectrum = card.get("spectrum") or {}
+            try:
+                target = (float(spectrum["valence"]), float(spectrum["arousal"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+            if card.get("id") and card.get("raw_text"):
+                samples.append((card["id"], card["raw_text"], target))
+        if not samples:
+            return self
+
+        source = hashlib.sha1(os.path.abspath(jsonl_path).encode("utf-8")).hexdigest()[:12]
+        model = self.model_name.replace("/", "_")
+        cache_path = os.path.join(self.cache_dir, f"cards_{model}_{source}.npz")
+        cached = {}
+        if os.path.exists(cache_path):
+            data = np.load(cache_path, allow_pickle=False)
+            cached = dict(zip(data["ids"].tolist(), data["vectors"]))
+        missing = [(cid, text) for cid, text, _ in samples if cid not in cached]
+        if missing:
+            vectors = self._encode([text for _, text in missing])
+            cached.update(zip((cid for cid, _ in missing), vectors))
+            os.makedirs(self.cache_dir, exist_ok=True)
+            ids = list(cached)
+            np.savez(cache_path, ids=np.array(ids), vectors=np.stack([cached[i] for i in ids]))
+
+        self.card_vectors = np.stack([cached[cid] for cid, _, _ in samples])
+        self.card_targets = np.array([target for _, _, target in samples], dtype=np.float32)
+        if len(samples) >= min_cards:
+            # 岭回归闭式解：W = (XᵀX + λI)⁻¹ Xᵀy，带偏置列
+            x = np.hstack([self.card_vectors, np.ones((len(samples), 1), dtype=np.float32)])
+            reg = ridge * np.eye(x.shape[1], dtype=np.float32)
+            reg[-1, -1] = 0.0
+            self.head = np.linalg.solve(x.T @ x + reg, x.T @ self.card_targets)
+        return self
+
+    # ---------- 推断 ----------
+
+    def _predict_spectrum(self, vectors, tone_idx):
+        if self.head is not None:
+            x = np.hstack([vectors, np.ones((len(vectors), 1), dtype=np.float32)])
+            pred = x @ self.head
+        elif self.card_vectors is not None:
+            sims = vectors @ self.card_vectors.T
+            k = min(5, sims.shape[1])
+            idx = np.argsort(-sims, axis=1)[:, :k]
+            weights = np.clip(np.take_along_axis(sims, idx, axis=1), 1e-3, None)
+            pred = (self.card_targets[idx] * weights[..., None]).sum(1) / weights.sum(1, keepdims=True)
+        else:
+            pred = []
+            for row in tone_idx:
+                priors = [
+                    QUADRANT_PRIORS[self.tone_quadrant[self.tones[i]]]
+                    for i in row
+                    if self.tones[i] in self.tone_quadrant
+                ]
+                pred.append(np.mean(priors, axis=0) if priors else (0.0, 0.5))
+            pred = np.array(pred, dtype=np.float32)
+        valence = np.clip(pred[:, 0], -1.0, 1.0)
+        arousal = np.clip(pred[:, 1], 0.0, 1.0)
+        return valence, arousal
+
+    def classify_batch(self, texts: list[str], seed: int | None = None) -> list[dict]:
+        """批量分类，返回与模型 draft 结构一致的字典（不含 reply）"""
+        if not texts:
+            return []
+        rng = random.Random(seed)
+        vectors = self._encode(texts)
+        tone_sims = vectors @ self.tone_vectors.T
+        tone_idx = np.argsort(-tone_sims, axis=1)[:, : self.top_tones]
+        valence, arousal = self._predict_spectrum(vectors, tone_idx)
+
+        drafts = []
+        for i, text in enumerate(texts):
+            v = "highV" if valence[i] >= 0 else "lowV"
+            a = "highA" if arousal[i] >= 0.5 else "lowA"
+            domain = self.domains_map[f"{v}_{a}"]
+            image_sims = self.image_vectors[domain] @ vectors[i]
+            images = [self.domain_images[domain][j] for j in np.argsort(-image_sims)[:3]]
+            tones = [self.tones[j] for j in tone_idx[i]]
+            drafts.append(
+                {
+                    "summary": "",
+                    "keywords": images,
+                    "spectrum": {
+                        "valence": round(float(valence[i]), 2),
+                        "arousal": round(float(arousal[i]), 2),
+                        "tones": tones,
+                    },
+                    "thinking": f"本地预分类：最接近的色调为 {'、'.join(tones)}，意象取自 {domain} 域。",
+                    "metaphor_domain": domain,
+                    "metaphor_seed": rng.randint(0, 99999),
+                }
+            )
+        return drafts
+
+    def classify(self, text: str) -> dict:
+        return self.classify_batch([text])[0]
@@ -0,0 +1,282 @@
+"""
+轻量的分段计时与指标导出，替代散落的 print 观察耗时。
+
+- span(name)：可嵌套的计时段，结束时记入 amnesia_span_seconds{span=...}，嵌套路径写入 path 标签
+- observe / incr：记录任意数值分布（如 TTFB、token 数）与计数（如重试次数）
+- render_prometheus / start_metrics_server：Prometheus 文本格式，或 HTTP /metrics 端点
+- start_json_dump：定期把指标快照写成 JSON
+- SamplingProfiler：按固定间隔采样线程栈，输出折叠栈（可直接喂给 flamegraph）
+"""
+
+from __future__ import annotations
+
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_RESERVOIR = 1024
+
+_stack: contextvars.ContextVar[tuple[str, ...]] = contextvars.ContextVar("span_stack", default=())
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+class Metrics:
+    """进程内指标表：计数器 + 带最近样本的分布"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: dict[tuple, float] = {}
+        self.summaries: dict[tuple, dict] = {}
+
+    def incr(self, name: str, value: float = 1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            s = self.summaries.get(key)
+            if s is None:
+                s = self.summaries[key] = {
+                    "count": 0,
+                    "sum": 0.0,
+                    "max": 0.0,
+                    "recent": deque(maxlen=_RESERVOIR),
+                }
+            s["count"] += 1
+            s["sum"] += value
+            s["max"] = max(s["max"], value)
+            s["recent"].append(value)
+
+    def snapshot(self) -> dict:
+        """返回可 JSON 序列化的快照，分位数按最近样本计算"""
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self.counters.items()
+            ]
+            summaries = []
+            for (name, labels), s in self.summaries.items():
+                recent = sorted(s["recent"])
+                summaries.append(
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": s["count"],
+                        "sum": s["sum"],
+                        "max": s["max"],
+                        "p50": _quantile(recent, 0.5),
+                        "p90": _quantile(recent, 0.9),
+                        "p99": _quantile(recent, 0.99),
+                    }
+                )
+        return {"timestamp": time.time(), "counters": counters, "summaries": summaries}
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.summaries.clear()
+
+
+def _quantile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+METRICS = Metrics()
+
+
+def incr(name: str, value: float = 1, **labels):
+    METRICS.incr(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    METRICS.observe(name, value, **labels)
+
+
+@contextmanager
+def span(name: str, **labels):
+    """
+    计时段，可嵌套：
+
+        with span("rag.query"):
+            with span("chroma.query"):
+                ...
+
+    耗时记入 amnesia_span_seconds；异常时额外计入 amnesia_span_errors_total。
+
+    span 的进入与退出需在同一个上下文中：不要在生成器里跨 yield 持有 span
+    （Starlette 等框架会在不同的上下文里逐次 next()），流式场景请手动计时后调用 observe。
+    """
+    parent = _stack.get()
+    token = _stack.set(parent + (name,))
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        incr("amnesia_span_errors_total", span=name, **labels)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        try:
+            _stack.reset(token)
+        except ValueError:
+            # 退出时已不在进入时的上下文里（跨 yield / 跨任务），恢复为父路径即可
+            _stack.set(parent)
+        observe("amnesia_span_seconds", elapsed, span=name, path="/".join(parent + (name,)), **labels)
+
+
+def current_span() -> str:
+    return "/".join(_stack.get())
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict, extra: dict | None = None) -> str:
+    merged = dict(labels)
+    if extra:
+        merged.update(extra)
+    if not merged:
+        return ""
+    body = ",".join(f'{k}="{_escape(v)}"' for k, v in merged.items())
+    return "{" + body + "}"
+
+
+def render_prometheus(metrics: Metrics = METRICS) -> str:
+    """按 Prometheus 文本格式输出全部指标"""
+    snap = metrics.snapshot()
+    lines = []
+    typed = set()
+    # 同名指标的样本必须连续输出
+    for c in sorted(snap["counters"], key=lambda c: c["name"]):
+        if c["name"] not in typed:
+            lines.append(f"# TYPE {c['name']} counter")
+            typed.add(c["name"])
+        lines.append(f"{c['name']}{_format_labels(c['labels'])} {c['value']}")
+    for s in sorted(snap["summaries"], key=lambda s: s["name"]):
+        name = s["name"]
+        if name not in typed:
+            lines.append(f"# TYPE {name} summary")
+            typed.add(name)
+        for q, quantile in (("p50", "0.5"), ("p90", "0.9"), ("p99", "0.99")):
+            lines.append(f"{name}{_format_labels(s['labels'], {'quantile': quantile})} {s[q]}")
+        lines.append(f"{name}_sum{_format_labels(s['labels'])} {s['sum']}")
+        lines.append(f"{name}_count{_format_labels(s['labels'])} {s['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(port: int = 9464, host: str = "0.0.0.0"):
+    """在后台线程中提供 GET /metrics"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("/metrics", ""):
+                self.send_error(404)
+                return
+            body = render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"📈 指标端点：http://{host}:{port}/metrics")
+    return server
+
+
+def start_json_dump(path: str, interval: float = 60.0):
+    """每隔 interval 秒把指标快照写入 path（原子替换）"""
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(METRICS.snapshot(), f, ensure_ascii=False, indent=2)
+            os.replace(tmp, path)
+
+    threading.Thread(target=run, name="metrics-dump", daemon=True).start()
+    return stop
+
+
+class SamplingProfiler:
+    """
+    采样式剖析：后台线程每隔 interval 秒抓取其他线程的调用栈并计数
+
+        with SamplingProfiler() as prof:
+            rag.load_data(...)
+        prof.dump("load_data.folded")
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            parts = []
+            while frame is not None and len(parts) < self.max_depth:
+                code = frame.f_code
+                parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(parts))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def top(self, n: int = 20):
+        """按叶子函数汇总的热点"""
+        leaves: Counter = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(n)
+
+    def dump(self, path: str):
+        """写出折叠栈格式：每行 "a;b;c 次数" """
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
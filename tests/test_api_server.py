@@ -0,0 +1,80 @@
+"""HTTP API：/query 的回答流要能完整读完"""
+
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from rag.api_server import create_app  # noqa: E402
+from scripts import tracing  # noqa: E402
+from scripts.openai_client import stream_chat_completion  # noqa: E402
+
+CHUNKS = ["回忆", "像雨", "一样落下。"]
+
+
+class _SSEHandler(BaseHTTPRequestHandler):
+    """按 OpenAI 的 SSE 格式逐段返回 CHUNKS"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for text in CHUNKS:
+            chunk = {"choices": [{"delta": {"content": text}}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def llm_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SSEHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    server.shutdown()
+
+
+class _Registry:
+    """只实现 /query 用到的部分，回答流直接来自 stream_chat_completion"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def query_stream(self, user_id, question, **kwargs):
+        return stream_chat_completion(self.base_url, None, "mock", [{"role": "user", "content": question}])
+
+
+def _span_count(name):
+    return sum(
+        s["count"] for s in tracing.METRICS.snapshot()["summaries"] if s["labels"].get("span") == name
+    )
+
+
+def test_query_streams_to_the_end(llm_url, monkeypatch):
+    # create_app 会导入 scripts.input，其提示词按项目根目录的相对路径读取
+    monkeypatch.chdir(ROOT)
+    client = TestClient(create_app(_Registry(llm_url)))
+    before = _span_count("llm.chat_completion_stream")
+
+    with client.stream("POST", "/query", json={"question": "下雨天"}) as resp:
+        assert resp.status_code == 200
+        body = "".join(resp.iter_text())
+
+    assert body == "".join(CHUNKS)
+    assert _span_count("llm.chat_completion_stream") == before + 1
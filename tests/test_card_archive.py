@@ -0,0 +1,61 @@
+"""按月分层：往月卡片移入分片，cards.jsonl 只留当月"""
+
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from scripts import card_archive  # noqa: E402
+from scripts.card_archive import CardArchive, iter_archived  # noqa: E402
+from scripts.card_store import encode_card, get_writer, iter_cards, make_card  # noqa: E402
+
+
+def _card(text, year, month, day):
+    return dict(make_card(text, {}), created_at=int(datetime(year, month, day, 12).timestamp() * 1000))
+
+
+def _write(path, cards, mode="wb"):
+    with open(path, mode) as f:
+        f.writelines(encode_card(card) for card in cards)
+
+
+def test_write_moves_past_months_out_of_hot_file(tmp_path):
+    path = str(tmp_path / "cards.jsonl")
+    old = [_card("去年的一张", 2025, 9, 19), _card("去年今天", 2025, 10, 19)]
+    _write(path, old)
+
+    writer = get_writer(path)
+    writer.append(make_card("今天的卡片", {}))
+    writer.close()
+
+    assert [c["raw_text"] for c in iter_cards(path)] == ["今天的卡片"]
+    assert [c["id"] for batch in iter_archived(path) for c in batch] == [c["id"] for c in old]
+    archive = CardArchive(source=path)
+    assert len(archive.query_range("2025-01-01", "2100-01-01")) == 3
+    assert [c["id"] for c in archive.on_this_day((10, 19))[2025]] == [old[1]["id"]]
+
+
+def test_interrupted_sync_is_replayed_without_duplicates(tmp_path):
+    path = str(tmp_path / "cards.jsonl")
+    card = _card("上个月的卡片", 2025, 9, 1)
+    _write(path, [card])
+    archive = CardArchive(source=path)
+    # 模拟上次归档写完分片、还没来得及裁剪热文件与写 manifest 就中断
+    Path(archive.root).mkdir()
+    _write(archive.shard_path("2025-09"), [card])
+
+    assert archive.sync() == 0
+    assert list(iter_cards(path)) == []
+    assert [c["id"] for batch in iter_archived(path) for c in batch] == [card["id"]]
+
+
+def test_today_rejects_impossible_date(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["card_archive.py", "--source", str(tmp_path / "cards.jsonl"), "today", "02-30"])
+    with pytest.raises(SystemExit):
+        card_archive.main()
+    assert "02-30" in capsys.readouterr().err
@@ -0,0 +1,57 @@
+"""写入去重：旁路文件恢复与增量追读"""
+
+import json
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from scripts.card_dedup import DedupIndex  # noqa: E402
+
+
+def _write(path, cards, mode="w"):
+    with open(path, mode, encoding="utf-8") as f:
+        for card in cards:
+            f.write(json.dumps(card, ensure_ascii=False) + "\n")
+
+
+def test_sidecar_restores_index_and_tails_new_cards(tmp_path):
+    path = str(tmp_path / "cards.jsonl")
+    cards = [
+        {"id": f"c{i}", "raw_text": f"第{i}天，下班路上看到晚霞，突然很想给家里打个电话，编号{i * 7919}"}
+        for i in range(300)
+    ]
+    _write(path, cards)
+    built = DedupIndex()
+    built.refresh(path)
+    built.save()
+
+    _write(path, [{"id": "late", "raw_text": "深夜一个人在便利店吃关东煮，热气糊住了眼镜"}], mode="a")
+    restored = DedupIndex()
+    restored.refresh(path)
+
+    assert restored.offset == Path(path).stat().st_size
+    assert len(restored.signatures) == len(cards) + 1
+    assert restored.check(cards[42])["id"] == "c42"
+    near = dict(cards[123], raw_text=cards[123]["raw_text"] + "。")
+    assert restored.check(near)["id"] == "c123"
+    late = restored.check({"raw_text": "深夜一个人在便利店吃关东煮，热气糊住了眼镜呀"})
+    assert late["kind"] == "minhash" and late["id"] == "late"
+
+
+def test_sidecar_of_replaced_file_is_ignored(tmp_path):
+    path = tmp_path / "cards.jsonl"
+    _write(path, [{"id": "old", "raw_text": "旧文件里的一张卡片，内容足够长"}])
+    index = DedupIndex()
+    index.refresh(str(path))
+    index.save()
+
+    replacement = tmp_path / "new.jsonl"
+    _write(replacement, [{"id": "new", "raw_text": "新文件里的另一张卡片，完全不同"}])
+    replacement.replace(path)
+    fresh = DedupIndex()
+    fresh.refresh(str(path))
+
+    assert set(fresh.signatures) == {"new"}
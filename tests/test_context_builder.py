@@ -0,0 +1,28 @@
+"""上下文打包：token 预算是硬上限"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from rag.context_builder import estimate_tokens, pack_context  # noqa: E402
+
+DOCS = ["项目说明：" + "情绪卡片记录与检索。" * 200, "the quick brown fox " * 300]
+METAS = [{"source": "project", "path": "a.md"}, {"source": "project", "path": "b.md"}]
+
+
+@pytest.mark.parametrize("budget", [1, 2, 10, 30, 49, 200])
+def test_tiny_budget_is_a_hard_cap(budget):
+    packed, stats = pack_context(DOCS, METAS, token_budget=budget, verbose=False)
+    assert stats["final_tokens"] <= budget
+    assert sum(estimate_tokens(e["text"]) for e in packed) <= budget
+
+
+def test_first_entry_kept_when_it_fits_after_cutting():
+    packed, stats = pack_context(DOCS, METAS, token_budget=30, verbose=False)
+    assert len(packed) == 1 and packed[0]["text"].startswith("项目说明")
+    assert packed[0]["text"].endswith("…")
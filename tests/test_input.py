@@ -0,0 +1,40 @@
+"""CSV 导入：编码嗅探与逐行读取"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+
+@pytest.fixture
+def input_module(monkeypatch):
+    # scripts.input 在导入时按项目根目录的相对路径读取提示词
+    monkeypatch.chdir(ROOT)
+    import scripts.input as module
+
+    return module
+
+
+def test_gbk_rows_after_long_ascii_prefix(input_module, tmp_path):
+    rows = ["今天下雨了，有点想家", "程序终于跑通了"]
+    path = tmp_path / "raw.csv"
+    header = b"".join(b"note %05d\n" % i for i in range(input_module.SNIFF_BYTES // 10 + 1))
+    assert len(header) > input_module.SNIFF_BYTES
+    path.write_bytes(header + "".join(row + "\n" for row in rows).encode("gbk"))
+
+    assert input_module.sniff_encoding(str(path)) == "gb18030"
+    texts = list(input_module.iter_csv_rows(str(path)))
+    assert texts[-2:] == rows
+    assert not any("�" in text for text in texts)
+
+
+def test_undecodable_rows_are_skipped(input_module, tmp_path):
+    path = tmp_path / "raw.csv"
+    path.write_bytes("第一行\n".encode("utf-8") + "第二行\n".encode("gbk") + "第三行\n".encode("utf-8"))
+
+    texts = list(input_module.iter_csv_rows(str(path), encoding="utf-8"))
+    assert texts == ["第一行", "第三行"]
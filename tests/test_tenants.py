@@ -0,0 +1,112 @@
+"""多用户图书馆：回答流的租约在任何结束方式下都要归还"""
+
+import gc
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("sentence_transformers")
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import rag.tenants as tenants  # noqa: E402
+
+
+class _Embedder:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_sentence_embedding_dimension(self):
+        return 8
+
+
+class _Collection:
+    def get(self, include=None):
+        return {"ids": [], "documents": []}
+
+    def count(self):
+        return 0
+
+
+class _RAG:
+    """不加载模型的 EmotionRAG 替身，只保留注册表用到的接口"""
+
+    def __init__(self, **kwargs):
+        self.collection = _Collection()
+        self.ingest_listeners = []
+        self.jsonl_path = None
+
+    def drop(self):
+        self.collection = None
+
+    def query_stream(self, question, **kwargs):
+        yield "回答"
+
+
+class _Tailer:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def poll_once(self):
+        return 0
+
+
+@pytest.fixture
+def registry(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(tenants, "SentenceTransformer", _Embedder)
+    monkeypatch.setattr(tenants.chromadb, "Client", lambda: None)
+    monkeypatch.setattr(tenants, "EmotionRAG", _RAG)
+    monkeypatch.setattr(tenants, "CardTailer", _Tailer)
+    return tenants.TenantRegistry(max_resident=1)
+
+
+def _refs(registry, user_id):
+    tenant = registry._resident.get(user_id) or registry._draining.get(user_id)
+    return tenant["refs"] if tenant else 0
+
+
+def test_stream_closed_before_iteration_releases_lease(registry):
+    stream = registry.query_stream("alice", "下雨天")
+    assert _refs(registry, "alice") == 1
+    stream.close()
+    assert _refs(registry, "alice") == 0
+
+
+def test_unstarted_stream_released_when_collected(registry):
+    stream = registry.query_stream("alice", "下雨天")
+    registry.get("bob")  # 淘汰 alice，但租约未还，集合暂不删除
+    assert "alice" in registry._draining
+    del stream
+    gc.collect()
+    assert "alice" not in registry._draining
+
+
+def test_stream_read_to_end_releases_lease(registry):
+    assert list(registry.query_stream("alice", "下雨天")) == ["回答"]
+    assert _refs(registry, "alice") == 0
+
+
+class _ToneClassifier:
+    def __init__(self, **kwargs):
+        self.trained_on = None
+
+    def fit_from_cards(self, jsonl_path):
+        self.trained_on = jsonl_path
+        return self
+
+
+def test_classifier_trained_per_user_and_dropped_with_tenant(registry, monkeypatch):
+    monkeypatch.setattr(tenants, "ToneClassifier", _ToneClassifier)
+    alice = registry.classifier("alice")
+    assert alice.trained_on == tenants.user_cards_path("alice")
+    assert registry.classifier("alice") is alice
+
+    registry.get("alice")
+    registry.get("bob")  # max_resident=1：淘汰 alice，预分类器随之丢弃
+    assert "alice" not in registry._classifiers
+    assert registry.classifier("alice") is not alice